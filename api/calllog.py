@@ -14,6 +14,8 @@ class CallLogsResponse(GenericResponse):
         super().__init__(*args, **kwargs)
         self.entries = self.response.body["entries"]
         self.totalCount = self.response.body["totalCount"]
+        if "nextPage" in self.response.body:
+            self.nextPage = self.response.body["nextPage"]
 
 
 class CallLogByIdResponse(GenericResponse):
@@ -1,6 +1,15 @@
-from ..request import Request, Response
-from ..interface.defs import Endpoint, Method
-from .generic import GenericResponse, GenericTransaction
+import csv
+import os
+import time
+from collections import deque
+from dataclasses import dataclass, field
+
+from ..harness import Harness
+from ..request import Request, Response, TransactionError
+from ..interface.defs import Endpoint, Method, Status
+from .. import log
+from .generic import GenericResponse, GenericTransaction, pipelining
+from .paging import Pages
 
 '''
 NewContactEntry = {
@@ -34,6 +43,8 @@ class Contacts(GenericResponse):
         super().__init__(*args, **kwargs)
         self.entries = self.response.body["entries"]
         self.totalCount = self.response.body["totalCount"]
+        if "nextPage" in self.response.body:
+            self.nextPage = self.response.body["nextPage"]
 
 
 class ContactByIdEntry(GenericResponse):
@@ -49,10 +60,10 @@ class AddedContactId(GenericResponse):
 
 
 class UpdatedContactId(GenericResponse):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        if self.response.status is "409":
-            self.id = self.response.body["id"]
+    '''
+    Conflict never gets here, it fails validation: id of existing contact is in TransactionError.response.body
+    '''
+    pass
 
 
 class GetContactsCount(GenericTransaction):
@@ -106,6 +117,7 @@ class AddContact(GenericTransaction):
 class UpdateContact(GenericTransaction):
     """
     Update existing contact
+    number used by other contact raises TransactionError with Conflict status, see: UpdatedContactId
     """
 
     def __init__(self, updatedContactRecord):
@@ -125,3 +137,213 @@ class DeleteContactById(GenericTransaction):
 
     def setResponse(self, response: Response):
         self.response = GenericResponse(response)
+
+
+contact_fields = ["address", "altName", "email", "blocked", "favourite", "ice",
+                  "numbers", "numbersIDs", "speedDial", "priName", "note"]
+contact_lists = ["numbers", "numbersIDs"]
+contact_flags = ["blocked", "favourite", "ice"]
+
+
+@dataclass
+class ContactsBulkResult:
+    '''
+    result of import_contacts/export_contacts
+        added - {record index: new contact id}
+        conflicts - {record index: id of existing contact with the same number}
+        failed - {record index: error}
+    '''
+    count: int = 0
+    elapsed_s: float = 0.0
+    added: dict = field(default_factory=dict)
+    conflicts: dict = field(default_factory=dict)
+    failed: dict = field(default_factory=dict)
+
+    def records_per_s(self) -> float:
+        return self.count / self.elapsed_s if self.elapsed_s else 0.0
+
+
+def read_contacts_csv(path: str):
+    '''
+    NewContactEntry dicts from csv file with header of NewContactEntry fields,
+    numbers and numbersIDs separated with `;`
+    '''
+    with open(path, newline="") as file:
+        for row in csv.DictReader(file):
+            entry = {}
+            for key in contact_fields:
+                value = row.get(key) or ""
+                if key in contact_lists:
+                    entry[key] = [item for item in value.split(";") if item]
+                elif key in contact_flags:
+                    entry[key] = value.lower() in ("true", "1", "yes")
+                else:
+                    entry[key] = value
+            yield entry
+
+
+def write_contacts_csv(path: str, contacts) -> int:
+    with open(path, "w", newline="") as file:
+        writer = csv.DictWriter(file, ["id"] + contact_fields, extrasaction="ignore")
+        writer.writeheader()
+        count = 0
+        for contact in contacts:
+            row = dict(contact)
+            for key in contact_lists:
+                row[key] = ";".join(str(item) for item in row.get(key, []))
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+def _vcard_escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\n", "\\n")
+
+
+def _vcard_split(value: str) -> list:
+    '''
+    split vCard property value on not escaped `;` and unescape parts
+    '''
+    parts = [""]
+    chars = iter(value)
+    for char in chars:
+        if char == "\\":
+            char = next(chars, "")
+            parts[-1] += "\n" if char in ("n", "N") else char
+        elif char == ";":
+            parts.append("")
+        else:
+            parts[-1] += char
+    return parts
+
+
+def _vcard_lines(file):
+    '''
+    vCard lines with folded ones joined
+    '''
+    line = None
+    for raw in file:
+        raw = raw.rstrip("\r\n")
+        if raw[:1] in (" ", "\t") and line is not None:
+            line += raw[1:]
+            continue
+        if line is not None:
+            yield line
+        line = raw
+    if line is not None:
+        yield line
+
+
+def read_contacts_vcard(path: str):
+    '''
+    NewContactEntry dicts from vCard file, supports N, FN, TEL, EMAIL, ADR and NOTE properties
+    '''
+    entry = None
+    with open(path) as file:
+        for line in _vcard_lines(file):
+            name, _, value = line.partition(":")
+            name = name.split(";")[0].upper()
+            if name == "BEGIN":
+                entry = {key: [] if key in contact_lists else False if key in contact_flags else ""
+                         for key in contact_fields}
+            elif entry is None:
+                continue
+            elif name == "END":
+                yield entry
+                entry = None
+            elif name == "N":
+                parts = _vcard_split(value) + ["", ""]
+                entry["altName"], entry["priName"] = parts[0], parts[1]
+            elif name == "FN" and not entry["priName"] and not entry["altName"]:
+                entry["priName"] = _vcard_split(value)[0]
+            elif name == "TEL":
+                entry["numbers"].append(_vcard_split(value)[0])
+            elif name == "EMAIL":
+                entry["email"] = _vcard_split(value)[0]
+            elif name == "ADR":
+                entry["address"] = " ".join(part for part in _vcard_split(value) if part)
+            elif name == "NOTE":
+                entry["note"] = _vcard_split(value)[0]
+
+
+def write_contacts_vcard(path: str, contacts) -> int:
+    count = 0
+    with open(path, "w") as file:
+        for contact in contacts:
+            priName, altName = contact.get("priName", ""), contact.get("altName", "")
+            file.write("BEGIN:VCARD\r\nVERSION:3.0\r\n")
+            file.write(f"N:{_vcard_escape(altName)};{_vcard_escape(priName)};;;\r\n")
+            file.write(f"FN:{_vcard_escape(' '.join(name for name in (priName, altName) if name))}\r\n")
+            for number in contact.get("numbers", []):
+                file.write(f"TEL:{_vcard_escape(number)}\r\n")
+            if contact.get("email"):
+                file.write(f"EMAIL:{_vcard_escape(contact['email'])}\r\n")
+            if contact.get("address"):
+                file.write(f"ADR:;;{_vcard_escape(contact['address'])};;;;\r\n")
+            if contact.get("note"):
+                file.write(f"NOTE:{_vcard_escape(contact['note'])}\r\n")
+            file.write("END:VCARD\r\n")
+            count += 1
+    return count
+
+
+def _is_vcard(path: str) -> bool:
+    return os.path.splitext(path)[1].lower() in (".vcf", ".vcard")
+
+
+def read_contacts(path: str):
+    '''
+    NewContactEntry dicts from .vcf/.vcard or csv file
+    '''
+    return read_contacts_vcard(path) if _is_vcard(path) else read_contacts_csv(path)
+
+
+def import_contacts(harness: Harness, contacts, window: int = 16) -> ContactsBulkResult:
+    '''
+    add many contacts, with up to `window` AddContact requests in flight
+        contacts - iterable of NewContactEntry dicts, or path to csv/vCard file
+    contacts with number already used on phone are reported in conflicts with existing contact id,
+    other failures in failed, import goes on in both cases
+    '''
+    if isinstance(contacts, str):
+        contacts = read_contacts(contacts)
+    result = ContactsBulkResult()
+    start = time.perf_counter()
+
+    def collect(index, future):
+        try:
+            result.added[index] = future.result().id
+        except TransactionError as e:
+            if e.status == Status.Conflict.value and e.response is not None:
+                result.conflicts[index] = e.response.body.get("id")
+            else:
+                result.failed[index] = e
+
+    with pipelining(harness):
+        in_flight = deque()
+        for index, entry in enumerate(contacts):
+            in_flight.append((index, AddContact(entry).submit(harness)))
+            result.count += 1
+            if len(in_flight) >= window:
+                collect(*in_flight.popleft())
+        while in_flight:
+            collect(*in_flight.popleft())
+    result.elapsed_s = time.perf_counter() - start
+    log.info(f"imported {len(result.added)} of {result.count} contacts, {len(result.conflicts)} conflicts, "
+             f"{len(result.failed)} failed, {result.records_per_s():.1f} records/s")
+    return result
+
+
+def export_contacts(harness: Harness, path: str, limit: int = 50) -> ContactsBulkResult:
+    '''
+    stream all contacts from phone to csv file, or vCard file for .vcf/.vcard path, page by page
+    '''
+    start = time.perf_counter()
+    contacts = Pages(harness, GetContactsWithOffsetAndLimit, limit)
+    if _is_vcard(path):
+        count = write_contacts_vcard(path, contacts)
+    else:
+        count = write_contacts_csv(path, contacts)
+    result = ContactsBulkResult(count, time.perf_counter() - start)
+    log.info(f"exported {count} contacts to {path}, {result.records_per_s():.1f} records/s")
+    return result
@@ -1,14 +1,25 @@
-from ..interface.error import TestError, Error
+from ..interface.error import TestError, Error, ComTimeout
+from ..interface.CDCSerial import CDCSerial
 from ..harness import Harness
-from ..request import Request, Response
-from ..interface.defs import Endpoint, Method
+from ..request import Request, Response, TransactionError
+from ..interface.defs import Endpoint, Method, Status
 from .. import log
-import base64
+import binascii
+import hashlib
+import json
+import math
+import mmap
+import queue
+import threading
+import time
+from concurrent.futures import wait, FIRST_COMPLETED
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+from typing import ClassVar
 from tqdm import tqdm
 import os
 import zlib
-from functools import partial
-from .generic import GenericResponse, GenericTransaction
+from .generic import GenericResponse, GenericTransaction, pipelining, run_pipelined
 
 
 class FsInitResponse(GenericResponse):
@@ -17,8 +28,9 @@ class FsInitResponse(GenericResponse):
         self.rxID = self.response.body["rxID"]
         self.chunkSize = self.response.body["chunkSize"]
         self.fileSize = self.response.body["fileSize"]
-        if "fileCrc32" in self.response.body:
-            log.debug(f'Expected CRC32 {self.response.body["fileCrc32"]}')
+        self.fileCrc32 = self.response.body.get("fileCrc32", "")
+        if self.fileCrc32:
+            log.debug(f'Expected CRC32 {self.fileCrc32}')
 
 
 class FsInitGet(GenericTransaction):
@@ -33,18 +45,33 @@ class FsInitGet(GenericTransaction):
 
 
 class FsGetChunkResponse(GenericResponse):
+    '''
+    chunk data is base64 decoded on first bin_data access
+    '''
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.bin_data = base64.standard_b64decode(self.response.body["data"][0:-1])
+        self.data = self.response.body["data"]
+        self.__bin_data = None
         self.fileCrc32 = ""
         if "fileCrc32" in self.response.body:
             self.fileCrc32 = self.response.body["fileCrc32"]
 
+    @property
+    def bin_data(self) -> bytes:
+        if self.__bin_data is None:
+            # decoded straight from json str: trailing newline is skipped by decoder, so neither
+            # slice nor ascii bytes copy of data is made
+            self.__bin_data = binascii.a2b_base64(self.data)
+        return self.__bin_data
+
 
 class FsGetChunk(GenericTransaction):
     '''
     Process single call to put next chunk of data Pure -> PC
     '''
+    # single chunk is cheap, stalled transfer is reported early
+    timeout = 10
+
     def __init__(self, id: int, chunkNo: int):
         self.request = Request(Endpoint.FILESYSTEM, Method.GET, {"rxID": id, "chunkNo": chunkNo})
 
@@ -85,31 +112,285 @@ class FsListFiles(GenericTransaction):
         return self.response.response.body[self.directory]
 
 
-def get_transfer(harness: Harness, logDir: str, fileName: str, rxID, fileSize, chunkSize):
+class TransferWindow:
     '''
-    Incomplete function to get file - transfering data chunks only
+    number of chunk requests kept in flight, adapted to measured latency:
+    enough requests to cover round trip time (the lowest one seen, so without queueing)
+    with chunks arriving back to back
+        size - initial window size
+        max_size - window size limit, fixed window when equal to size
     '''
-    totalChunks = int(((fileSize + chunkSize - 1) / chunkSize))
-    runningCrc32 = 0
-    log.info(f'Transfering {fileName} to {logDir}:')
-    with open(os.path.join(logDir, fileName), 'wb') as logFile:
-        with tqdm(total=fileSize, unit='B', unit_scale=True) as p_bar:
-            for n in range(1, totalChunks + 1):
-                p_bar.update(chunkSize)
-                ret = FsGetChunk(rxID, n).run(harness)
-                logFile.write(ret.bin_data)
-                runningCrc32 = zlib.crc32(ret.bin_data, runningCrc32)
+    def __init__(self, size: int = 4, max_size: int = 32):
+        self.size = size
+        self.max_size = max_size
+        self.min_rtt = None
+        self.interval = None
+        self.last_arrival = None
+
+    def on_chunk(self, sent: float, arrived: float):
+        rtt = arrived - sent
+        self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+        if self.last_arrival is not None:
+            interval = arrived - self.last_arrival
+            self.interval = interval if self.interval is None else 0.875 * self.interval + 0.125 * interval
+        self.last_arrival = arrived
+        if self.interval:
+            self.size = max(1, min(self.max_size, math.ceil(self.min_rtt / self.interval) + 1))
+
+
+@dataclass
+class TransferCheckpoint:
+    '''
+    progress of get_file/put_file kept in json file, lets to resume interrupted transfer
+        id - rxID or txID of transfer
+        chunks - number of chunks done, in order
+        crc32 - running CRC32 of these chunks (get only)
+    '''
+    path: str
+    direction: str = ""
+    remote: str = ""
+    id: int = 0
+    chunkSize: int = 0
+    fileSize: int = 0
+    fileCrc32: str = ""
+    chunks: int = 0
+    crc32: int = 0
+    # minimal time between checkpoint file updates
+    save_interval_s: ClassVar[float] = 1.0
+    # where checkpoints of_transfer are kept
+    directory: ClassVar[str] = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+                                            "harness", "transfers")
+
+    def __post_init__(self):
+        self.saved = 0.0
+
+    @classmethod
+    def load(cls, path: str):
+        '''
+        checkpoint stored in path, empty one if there is none or it's broken
+        '''
+        try:
+            with open(path) as file:
+                return cls(path, **json.load(file))
+        except (OSError, ValueError, TypeError):
+            return cls(path)
+
+    @classmethod
+    def of_transfer(cls, harness: Harness, direction: str, local: str, remote: str):
+        '''
+        checkpoint of transfer between local file and remote one on phone connected to harness,
+        phones are told apart by USB serial number, or by port name if there is none
+        '''
+        device = CDCSerial.find_serial_number(harness.port_name) or harness.port_name
+        key = "\0".join((device, direction, os.path.abspath(local), remote))
+        return cls.load(os.path.join(cls.directory, hashlib.sha1(key.encode()).hexdigest() + ".json"))
+
+    def resumes(self, direction: str, remote: str, fileSize: int, fileCrc32: str, chunkSize: int = None) -> bool:
+        '''
+        checks if checkpoint is of the same, partially done transfer
+        '''
+        return (self.chunks > 0 and self.direction == direction and self.remote == remote and
+                self.fileSize == fileSize and self.fileCrc32 == fileCrc32 and
+                chunkSize in (None, self.chunkSize))
+
+    def start(self, direction: str, remote: str, id: int, chunkSize: int, fileSize: int, fileCrc32: str):
+        self.direction = direction
+        self.remote = remote
+        self.id = id
+        self.chunkSize = chunkSize
+        self.fileSize = fileSize
+        self.fileCrc32 = fileCrc32
+        self.chunks = 0
+        self.crc32 = 0
+        self.save()
+
+    def update(self, chunks: int, crc32: int = 0, fd: int = None, force=False):
+        '''
+        record progress, saved at most every save_interval_s unless forced
+        fd - file with received data, flushed to disk before checkpoint is saved
+        '''
+        self.chunks = chunks
+        self.crc32 = crc32
+        if force or time.monotonic() - self.saved >= self.save_interval_s:
+            if fd is not None:
+                os.fdatasync(fd)
+            self.save()
+
+    def save(self):
+        state = asdict(self)
+        del state["path"]
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".tmp", "w") as file:
+            json.dump(state, file)
+        os.replace(self.path + ".tmp", self.path)
+        self.saved = time.monotonic()
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+@dataclass
+class TransferResult:
+    '''
+    summary of get_file/put_file transfer
+        expected_crc32 - CRC32 reported by phone for get, of local file for put, empty if unknown
+        actual_crc32 - CRC32 of received data for get, the same as expected when phone accepted put
+        transferred - bytes sent in this call, less than size when transfer was resumed
+    '''
+    file: str
+    remote: str
+    size: int
+    transferred: int = 0
+    elapsed_s: float = 0.0
+    expected_crc32: str = ""
+    actual_crc32: str = ""
+
+    def verified(self) -> bool:
+        return self.expected_crc32 != ""
+
+    def ok(self) -> bool:
+        return self.expected_crc32 in ("", self.actual_crc32)
 
-            runningCrc32 = format((runningCrc32 & 0xFFFFFFFF), '08x')
-            log.debug(f'Expected CRC32 {ret.fileCrc32}, actual CRC32 {runningCrc32}')
+    def throughput(self) -> float:
+        '''
+        bytes per second
+        '''
+        return self.transferred / self.elapsed_s if self.elapsed_s else 0.0
 
 
-def get_file(harness: Harness, file_pure: str, path_local, path_pure: str = "/sys/user", file_user=""):
+class CrcMismatchError(Exception):
+    '''
+    transferred file is corrupted, result holds transfer details
+    '''
+    def __init__(self, result: TransferResult):
+        self.result = result
+        super().__init__(result)
+
+    def __str__(self):
+        return (f"{self.result.remote} CRC32 mismatch: expected {self.result.expected_crc32}, "
+                f"actual {self.result.actual_crc32 or 'unknown'}")
+
+
+class RunningCrc32:
+    '''
+    CRC32 of chunks added in order, with `threaded` counted in separate thread, so hashing overlaps with I/O
+    state is (chunks, crc) pair of chunks already counted, call finish to get final one
+    '''
+    def __init__(self, chunks: int = 0, crc: int = 0, threaded=False):
+        self.state = (chunks, crc)
+        self.queue = None
+        if threaded:
+            self.queue = queue.SimpleQueue()
+            self.thread = threading.Thread(target=self.__run, name="crc32", daemon=True)
+            self.thread.start()
+
+    def add(self, data):
+        if self.queue is None:
+            self.__add(data)
+        else:
+            self.queue.put(data)
+
+    def __add(self, data):
+        chunks, crc = self.state
+        self.state = (chunks + 1, zlib.crc32(data, crc))
+
+    def __run(self):
+        data = self.queue.get()
+        while data is not None:
+            self.__add(data)
+            data = self.queue.get()
+
+    def finish(self) -> tuple:
+        if self.queue is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.queue = None
+        return self.state
+
+    def hex(self) -> str:
+        return format((self.state[1] & 0xFFFFFFFF), '08x')
+
+
+def get_transfer(harness: Harness, logDir: str, fileName: str, rxID, fileSize, chunkSize,
+                 window: TransferWindow = None, checkpoint: TransferCheckpoint = None,
+                 fileCrc32: str = "", verify=True, verify_thread=False) -> TransferResult:
+    '''
+    Incomplete function to get file - transfering data chunks only
+    keeps window of FsGetChunk requests in flight, chunks are written at their offsets in preallocated file
+    as soon as they come, CRC is counted in chunks order, in separate thread with `verify_thread`
+    with checkpoint transfer continues after checkpoint.chunks, progress is recorded in it
+    ComTimeout is raised when no chunk comes for FsGetChunk.timeout
+    CRC is checked against fileCrc32, or one sent with last chunk, CrcMismatchError is raised
+    when it doesn't match, unless `verify` is False
+    '''
+    totalChunks = int(((fileSize + chunkSize - 1) / chunkSize))
+    window = TransferWindow() if window is None else window
+    done = 0 if checkpoint is None else checkpoint.chunks
+    runningCrc32 = RunningCrc32(done, 0 if checkpoint is None else checkpoint.crc32, verify_thread)
+    result = TransferResult(os.path.join(logDir, fileName), "", fileSize, expected_crc32=fileCrc32)
+    start = time.perf_counter()
+    log.info(f'Transfering {fileName} to {logDir}:')
+    with pipelining(harness), open(result.file, 'r+b' if done else 'wb') as logFile:
+        logFile.truncate(fileSize)
+        with tqdm(total=fileSize, initial=min(done * chunkSize, fileSize), unit='B', unit_scale=True) as p_bar:
+            pending = {}
+            received = {}
+            nextChunk = done + 1
+            nextCrcChunk = done + 1
+            try:
+                while nextChunk <= totalChunks or pending:
+                    while nextChunk <= totalChunks and len(pending) < window.size:
+                        future = FsGetChunk(rxID, nextChunk).submit(harness)
+                        pending[future] = (nextChunk, time.perf_counter())
+                        nextChunk += 1
+                    ready, _ = wait(pending, FsGetChunk.timeout, return_when=FIRST_COMPLETED)
+                    if not ready:
+                        # lost response, checkpoint is saved below
+                        raise ComTimeout("response", FsGetChunk.timeout)
+                    arrived = time.perf_counter()
+                    for future in ready:
+                        n, sent = pending.pop(future)
+                        ret = future.result()
+                        window.on_chunk(sent, arrived)
+                        os.pwrite(logFile.fileno(), ret.bin_data, (n - 1) * chunkSize)
+                        received[n] = ret.bin_data
+                        while nextCrcChunk in received:
+                            runningCrc32.add(received.pop(nextCrcChunk))
+                            nextCrcChunk += 1
+                        if ret.fileCrc32 and not result.expected_crc32:
+                            result.expected_crc32 = ret.fileCrc32
+                        result.transferred += len(ret.bin_data)
+                        p_bar.update(len(ret.bin_data))
+                    if checkpoint is not None:
+                        checkpoint.update(*runningCrc32.state, logFile.fileno())
+            except BaseException:
+                state = runningCrc32.finish()
+                if checkpoint is not None:
+                    checkpoint.update(*state, logFile.fileno(), force=True)
+                raise
+            runningCrc32.finish()
+
+    result.elapsed_s = time.perf_counter() - start
+    result.actual_crc32 = runningCrc32.hex()
+    log.debug(f'Expected CRC32 {result.expected_crc32}, actual CRC32 {result.actual_crc32}, '
+              f'{result.throughput() / 1024:.1f} kB/s, window {window.size}')
+    if verify and not result.ok():
+        raise CrcMismatchError(result)
+    return result
+
+
+def get_file(harness: Harness, file_pure: str, path_local, path_pure: str = "/sys/user", file_user="",
+             window: TransferWindow = None, resumable=True, verify=True, verify_thread=False) -> TransferResult:
     '''
     Complete function to get file:
         - Request to init get file: FsInitGet
-        - as many as it takes chunk transmissions: FsGetChunk (via get_transfer)
+        - as many as it takes chunk transmissions: FsGetChunk (via get_transfer),
+          with `window` of them in flight, TransferWindow(1, 1) to get chunks one by one
     printing pretty progress bar as it goes on
+    with `resumable` progress is kept in checkpoint, see: TransferCheckpoint.of_transfer, so transfer interrupted
+    i.e. by ComError or reboot continues from last verified chunk on next call, if file on phone is the same
+    returns TransferResult, CrcMismatchError is raised if received file is corrupted, see: get_transfer
     '''
     if file_user == "":
         file_user = file_pure
@@ -117,9 +398,32 @@ def get_file(harness: Harness, file_pure: str, path_local, path_pure: str = "/sy
     if not os.path.exists(path_local):
         os.makedirs(path_local, exist_ok = True)
 
+    remote = path_pure + "/" + file_pure
+    checkpoint = None
+    if resumable:
+        checkpoint = TransferCheckpoint.of_transfer(harness, "get", path_local + file_user, remote)
     ret = FsInitGet(path_pure, file_pure).run(harness)
-    get_transfer(harness, path_local, file_user, ret.rxID, ret.fileSize, ret.chunkSize)
+    if checkpoint is not None:
+        if checkpoint.resumes("get", remote, ret.fileSize, ret.fileCrc32, ret.chunkSize) and \
+                os.path.exists(path_local + file_user):
+            log.info(f"resuming {remote} from chunk {checkpoint.chunks + 1}")
+            checkpoint.id = ret.rxID
+        else:
+            checkpoint.start("get", remote, ret.rxID, ret.chunkSize, ret.fileSize, ret.fileCrc32)
+    try:
+        result = get_transfer(harness, path_local, file_user, ret.rxID, ret.fileSize, ret.chunkSize, window,
+                              checkpoint, ret.fileCrc32, verify, verify_thread)
+    except CrcMismatchError as e:
+        e.result.remote = remote
+        # corrupted data can't be resumed
+        if checkpoint is not None:
+            checkpoint.remove()
+        raise
+    result.remote = remote
+    if checkpoint is not None:
+        checkpoint.remove()
     log.info(f"file {file_pure} complete")
+    return result
 
 
 def get_log_file(harness: Harness, log_dir: str):
@@ -167,6 +471,8 @@ class FsPutChunk(GenericTransaction):
     '''
     Transaction putting single file chunk on Pure, depends on FsInitPut
     '''
+    timeout = 10
+
     def __init__(self, txID: int, chunkNo: int, data: bytearray):
         self.request = Request(Endpoint.FILESYSTEM, Method.PUT, {"txID": txID,
                                                                  "chunkNo": chunkNo,
@@ -176,27 +482,107 @@ class FsPutChunk(GenericTransaction):
         self.response = FsPutChunkResponse(response)
 
 
-def put_file(harness: Harness, file: str, where: str, filename: str = None):
+@contextmanager
+def map_file(file: str):
+    '''
+    read only memory map of local file as memoryview, file is not read to memory as a whole
+    '''
+    with open(file, 'rb') as l_file:
+        if os.fstat(l_file.fileno()).st_size == 0:
+            # empty file can't be mapped
+            yield memoryview(b"")
+            return
+        with mmap.mmap(l_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            with memoryview(data) as view:
+                yield view
+
+
+def file_crc32(file: str) -> str:
+    '''
+    CRC32 of local file in format used by filesystem endpoint, computed in single pass on memory map
+    '''
+    with map_file(file) as data:
+        return format((zlib.crc32(data) & 0xFFFFFFFF), '08x')
+
+
+def put_chunks(data: memoryview, txID: int, chunkSize: int, first: int = 1):
+    '''
+    lazy FsPutChunk transactions of data from chunk `first`, chunks are encoded straight from data
+    without copying them
+    '''
+    for chunkNo, offset in enumerate(range((first - 1) * chunkSize, len(data), chunkSize), first):
+        yield FsPutChunk(txID, chunkNo, binascii.b2a_base64(data[offset:offset + chunkSize], newline=False).decode())
+
+
+def put_file(harness: Harness, file: str, where: str, filename: str = None, window: int = 8,
+             resumable=True) -> TransferResult:
     '''
     Complete function to put file to Pure:
-        - Request to init get file: FsInitPut
-        - as many as it takes chunk transmissions: FsPutChunk (via get_transfer)
+        - Request to init put file: FsInitPut
+        - as many as it takes chunk transmissions: FsPutChunk, with up to `window` of them in flight
+    file is streamed from memory map, so memory use doesn't depend on file size
     printing pretty progress bar as it goes on
+    with `resumable` progress is kept in checkpoint, see: TransferCheckpoint.of_transfer, so interrupted transfer
+    continues from last confirmed chunk on next call, or starts again if phone rejects old txID
+    phone checks CRC32 of whole file when it gets last chunk, CrcMismatchError is raised if it doesn't match
+    returns TransferResult
     '''
     if filename is None:
         filename = os.path.split(file)[-1]
     fileSize = os.path.getsize(file)
-    with open(file, 'rb') as l_file:
-        file_data = l_file.read()
-        fileCrc32 = format((zlib.crc32(file_data) & 0xFFFFFFFF), '08x')
-
-    ret = FsInitPut(where, filename, fileSize, fileCrc32).run(harness)
-    chunkNo = 1
-
-    with open(file, 'rb') as l_file:
-        with tqdm(total=fileSize, unit='B', unit_scale=True, desc=f"{file} -> {where}/{filename}") as p_bar:
-            for chunk in iter(partial(l_file.read, ret.chunkSize), b''):
-                FsPutChunk(ret.txID, chunkNo, base64.standard_b64encode(
-                    chunk).decode()).run(harness)
-                chunkNo += 1
-                p_bar.update(ret.chunkSize)
+    fileCrc32 = file_crc32(file)
+    remote = where + "/" + filename
+    checkpoint = TransferCheckpoint.of_transfer(harness, "put", file, remote) if resumable else None
+    result = TransferResult(file, remote, fileSize, expected_crc32=fileCrc32)
+    start = time.perf_counter()
+
+    with pipelining(harness), map_file(file) as data:
+        done = 0
+        if checkpoint is not None and checkpoint.resumes("put", remote, fileSize, fileCrc32):
+            log.info(f"resuming {remote} from chunk {checkpoint.chunks + 1}")
+            txID, chunkSize, done = checkpoint.id, checkpoint.chunkSize, checkpoint.chunks
+            try:
+                # the first chunk is sent alone, to know if phone still has the transfer
+                for chunk in put_chunks(data, txID, chunkSize, done + 1):
+                    chunk.run(harness)
+                    result.transferred += min(chunkSize, fileSize - done * chunkSize)
+                    done += 1
+                    break
+            except TransactionError as e:
+                log.info(f"phone rejected transfer {txID} with status {e.status}, starting again")
+                done = 0
+        if done == 0:
+            ret = FsInitPut(where, filename, fileSize, fileCrc32).run(harness)
+            txID, chunkSize = ret.txID, ret.chunkSize
+            if checkpoint is not None:
+                checkpoint.start("put", remote, txID, chunkSize, fileSize, fileCrc32)
+
+        with tqdm(total=fileSize, initial=min(done * chunkSize, fileSize), unit='B', unit_scale=True,
+                  desc=f"{file} -> {where}/{filename}") as p_bar:
+            try:
+                for _ in run_pipelined(harness, put_chunks(data, txID, chunkSize, done + 1), window):
+                    chunk = min(chunkSize, fileSize - done * chunkSize)
+                    done += 1
+                    result.transferred += chunk
+                    p_bar.update(chunk)
+                    if checkpoint is not None:
+                        checkpoint.update(done)
+            except TransactionError as e:
+                if done * chunkSize < fileSize <= (done + 1) * chunkSize and e.status == Status.NotAcceptable.value:
+                    # last chunk rejected - phone got file with other CRC32
+                    if checkpoint is not None:
+                        checkpoint.remove()
+                    raise CrcMismatchError(result)
+                if checkpoint is not None:
+                    checkpoint.update(done, force=True)
+                raise
+            except BaseException:
+                if checkpoint is not None:
+                    checkpoint.update(done, force=True)
+                raise
+    if checkpoint is not None:
+        checkpoint.remove()
+    result.elapsed_s = time.perf_counter() - start
+    result.actual_crc32 = fileCrc32
+    log.debug(f"{remote} CRC32 {fileCrc32} confirmed, {result.throughput() / 1024:.1f} kB/s")
+    return result
@@ -1,3 +1,7 @@
+from collections import deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+
 from ..harness import Harness
 from ..request import Response
 '''
@@ -29,7 +33,10 @@ class GenericTransaction:
     '''
     Generic transaction class represenging Request->Response execution
     used to provide transactions i.e. PhoneModeLock transaction
+    timeout - deadline of single request in seconds, child class can set other one, None - no deadline
     '''
+    timeout = 60
+
     def getRequest(self):
         return self.request
 
@@ -47,6 +54,66 @@ class GenericTransaction:
 
     def run(self, harness: Harness):
         self.onRun(harness)
-        ret = harness.request(self.request.endpoint, self.request.method, self.request.body)
+        ret = harness.request(self.request.endpoint, self.request.method, self.request.body, self.timeout)
+        self.setResponse(ret.response)
+        return self.getResponse()
+
+    def submit(self, harness: Harness) -> Future:
+        '''
+        sends request without waiting for response, see: Harness.request_nowait
+        returns future resolved with getResponse(), or failed with ComTimeout after `timeout`
+        '''
+        self.onRun(harness)
+        result = Future()
+
+        def on_transaction(future: Future):
+            try:
+                self.setResponse(future.result().response)
+                result.set_result(self.getResponse())
+            except Exception as e:
+                result.set_exception(e)
+
+        harness.request_nowait(self.request.endpoint, self.request.method, self.request.body,
+                               self.timeout).add_done_callback(on_transaction)
+        return result
+
+    async def run_async(self, harness: Harness):
+        '''
+        asyncio equivalent of run, i.e. to query many phones at once:
+            await asyncio.gather(*(GetDeviceInfo().run_async(h) for h in harnesses))
+        '''
+        self.onRun(harness)
+        ret = await harness.request_async(self.request.endpoint, self.request.method, self.request.body,
+                                          self.timeout)
         self.setResponse(ret.response)
         return self.getResponse()
+
+
+@contextmanager
+def pipelining(harness: Harness):
+    '''
+    enable pipelining on harness for the time of the block, it stays on if other user enabled it too
+    '''
+    harness.enable_pipelining()
+    try:
+        yield harness
+    finally:
+        harness.disable_pipelining()
+
+
+def run_pipelined(harness: Harness, transactions, window: int = 8):
+    '''
+    runs transactions keeping up to `window` of them in flight, yields responses in order
+    transactions can be lazy generator, i.e.:
+        harness.enable_pipelining()
+        for chunk in run_pipelined(harness, (FsGetChunk(rxID, n) for n in range(1, total + 1))):
+            file.write(chunk.bin_data)
+    without pipelining enabled on harness transactions are executed one by one
+    '''
+    in_flight = deque()
+    for transaction in transactions:
+        in_flight.append(transaction.submit(harness))
+        if len(in_flight) >= window:
+            yield in_flight.popleft().result()
+    while in_flight:
+        yield in_flight.popleft().result()
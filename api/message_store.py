@@ -0,0 +1,157 @@
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict
+from collections.abc import MutableMapping
+
+from ..harness import Harness
+from ..interface.defs import SMSType
+from .generic import GenericTransaction
+from .messages import AddDraftMessage, AddMessage, DeleteMessageById, DeleteThreadById, \
+    GetMessagesWithOffsetAndLimit, UpdateDraftMessage
+from .paging import Pages
+
+'''
+Indexed local copy of phone messages, to look them up without scanning all pages over serial, i.e.:
+    store = MessageStore.load(harness)
+    store.run(harness, AddMessage("+48600000000", "hello"))
+    inbox = store.find(number="+48600000000", type=SMSType.INBOX, start=time.time() - 3600)
+'''
+
+
+def _sms_type(type) -> int:
+    return type.value if isinstance(type, SMSType) else type
+
+
+class MessageStore(MutableMapping):
+    '''
+    messageID -> message mapping with indexes by threadID, number, messageType and createdAt
+    query results are lists of messages ordered by createdAt, then messageID
+    can be used as DeviceMirror.messages to keep it up to date with outbox
+    '''
+
+    def __init__(self, messages=()):
+        self.messages = {}
+        self.by_thread = defaultdict(set)
+        self.by_number = defaultdict(set)
+        self.by_type = defaultdict(set)
+        # sorted (createdAt, messageID)
+        self.by_time = []
+        for message in messages:
+            self.add(message)
+
+    @classmethod
+    def load(cls, harness: Harness, limit: int = 50):
+        return cls(Pages(harness, GetMessagesWithOffsetAndLimit, limit))
+
+    def __getitem__(self, messageID):
+        return self.messages[messageID]
+
+    def __setitem__(self, messageID, message: dict):
+        if messageID in self.messages:
+            del self[messageID]
+        self.messages[messageID] = message
+        self.by_thread[message.get("threadID")].add(messageID)
+        self.by_number[message.get("number")].add(messageID)
+        self.by_type[message.get("messageType")].add(messageID)
+        insort(self.by_time, (message.get("createdAt", 0), messageID))
+
+    def __delitem__(self, messageID):
+        message = self.messages.pop(messageID)
+        for index, key in ((self.by_thread, message.get("threadID")), (self.by_number, message.get("number")),
+                           (self.by_type, message.get("messageType"))):
+            index[key].discard(messageID)
+            if not index[key]:
+                del index[key]
+        position = bisect_left(self.by_time, (message.get("createdAt", 0), messageID))
+        del self.by_time[position]
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    def __len__(self):
+        return len(self.messages)
+
+    def add(self, message: dict):
+        self[message["messageID"]] = message
+
+    def remove_thread(self, threadID: int) -> int:
+        '''
+        drop messages of thread, i.e. after DeleteThreadById, returns number of them
+        '''
+        messageIDs = list(self.by_thread.get(threadID, ()))
+        for messageID in messageIDs:
+            del self[messageID]
+        return len(messageIDs)
+
+    def run(self, harness: Harness, transaction: GenericTransaction):
+        '''
+        run transaction and apply its effect on messages to the store, returns transaction response
+        handles AddMessage, AddDraftMessage, UpdateDraftMessage, DeleteMessageById and DeleteThreadById
+        '''
+        response = transaction.run(harness)
+        body = transaction.request.body
+        if isinstance(transaction, (AddMessage, AddDraftMessage)):
+            self.add(response.message)
+        elif isinstance(transaction, UpdateDraftMessage) and body["messageID"] in self:
+            self[body["messageID"]] = dict(self[body["messageID"]], messageBody=body["messageBody"])
+        elif isinstance(transaction, DeleteMessageById):
+            self.pop(body["messageID"], None)
+        elif isinstance(transaction, DeleteThreadById):
+            self.remove_thread(body["threadID"])
+        return response
+
+    def __ordered(self, messageIDs) -> list:
+        def order(id):
+            return self.messages[id].get("createdAt", 0), id
+        return [self.messages[id] for id in sorted(messageIDs, key=order)]
+
+    def in_thread(self, threadID: int) -> list:
+        return self.__ordered(self.by_thread.get(threadID, ()))
+
+    def with_number(self, number: str) -> list:
+        return self.__ordered(self.by_number.get(number, ()))
+
+    def of_type(self, type) -> list:
+        '''
+        type - SMSType or its value
+        '''
+        return self.__ordered(self.by_type.get(_sms_type(type), ()))
+
+    def created_between(self, start=None, end=None) -> list:
+        '''
+        messages with start <= createdAt <= end, None for open range
+        '''
+        low = 0 if start is None else bisect_left(self.by_time, (start,))
+        high = len(self.by_time) if end is None else bisect_right(self.by_time, (end, float("inf")))
+        return [self.messages[id] for _, id in self.by_time[low:high]]
+
+    def threads(self) -> list:
+        return list(self.by_thread)
+
+    def thread_of(self, number: str):
+        '''
+        threadID of conversation with number, None if there are no messages with it
+        '''
+        for messageID in self.by_number.get(number, ()):
+            return self.messages[messageID].get("threadID")
+        return None
+
+    def find(self, threadID: int = None, number: str = None, type=None, start=None, end=None) -> list:
+        '''
+        messages matching all given criteria, the most selective index is scanned first
+        '''
+        candidates = []
+        if threadID is not None:
+            candidates.append(self.by_thread.get(threadID, set()))
+        if number is not None:
+            candidates.append(self.by_number.get(number, set()))
+        if type is not None:
+            candidates.append(self.by_type.get(_sms_type(type), set()))
+        if not candidates:
+            return self.created_between(start, end)
+        candidates.sort(key=len)
+        messageIDs = candidates[0].intersection(*candidates[1:])
+        if start is not None or end is not None:
+            low = float("-inf") if start is None else start
+            high = float("inf") if end is None else end
+            messageIDs = [id for id in messageIDs if low <= self.messages[id].get("createdAt", 0) <= high]
+        return self.__ordered(messageIDs)
@@ -259,7 +259,8 @@ class TemplatesWithOffsetAndLimitResponse(GenericResponse):
         super().__init__(*args, **kwargs)
         self.templates = self.response.body["entries"]
         self.totalCount = self.response.body["totalCount"]
-        self.nextPage = self.response.body["nextPage"]
+        if "nextPage" in self.response.body:
+            self.nextPage = self.response.body["nextPage"]
 
 
 class MessageTemplateResponse(GenericResponse):
@@ -0,0 +1,104 @@
+from ..harness import Harness
+from ..request import TransactionError
+from ..interface.defs import Status
+from .. import log
+from .contacts import GetContactById, GetContactsWithOffsetAndLimit
+from .generic import pipelining
+from .message_store import MessageStore
+from .messages import GetMessageById, GetMessagesWithOffsetAndLimit, GetThreadById, GetThreadsWithOffsetAndLimit
+from .outbox import DeleteNotifications, GetNotifications, NotificationChange, NotificationType
+from .paging import Pages
+
+
+class DeviceMirror:
+    '''
+    local copy of phone contacts, threads and messages, to check DB state without round trips
+    messages are kept in MessageStore, with its indexes for lookups
+    loaded once by paging, then kept up to date with outbox notifications:
+    only changed records are fetched again, notifications are acknowledged after they are applied
+    use example:
+        mirror = DeviceMirror(harness).load()
+        AddMessage("+48600000000", "hello").run(harness)
+        mirror.sync()
+        assert any(m["messageBody"] == "hello" for m in mirror.messages.values())
+    '''
+    def __init__(self, harness: Harness, limit: int = 50):
+        self.harness = harness
+        self.limit = limit
+        self.contacts = {}
+        self.threads = {}
+        self.messages = MessageStore()
+        self.tables = {
+            NotificationType.CONTACT: (self.contacts, "id", GetContactById),
+            NotificationType.THREAD: (self.threads, "threadID", GetThreadById),
+            NotificationType.MESSAGE: (self.messages, "messageID", GetMessageById),
+        }
+
+    def load(self):
+        '''
+        read all records from phone, pending notifications are dropped as already reflected in them
+        '''
+        self.acknowledge(GetNotifications().run(self.harness).entries)
+        pages = {
+            NotificationType.CONTACT: GetContactsWithOffsetAndLimit,
+            NotificationType.THREAD: GetThreadsWithOffsetAndLimit,
+            NotificationType.MESSAGE: GetMessagesWithOffsetAndLimit,
+        }
+        for type, transaction in pages.items():
+            table, key, _ = self.tables[type]
+            table.clear()
+            for record in Pages(self.harness, transaction, self.limit):
+                table[record[key]] = record
+        log.info(f"mirror loaded: {len(self.contacts)} contacts, {len(self.threads)} threads, "
+                 f"{len(self.messages)} messages")
+        return self
+
+    def acknowledge(self, entries: list):
+        if entries:
+            DeleteNotifications([entry.uid for entry in entries]).run(self.harness)
+
+    def sync(self) -> int:
+        '''
+        apply changes reported in outbox, returns number of changed records
+        '''
+        entries = GetNotifications().run(self.harness).entries
+        # the last change of record wins
+        changes = {}
+        for entry in entries:
+            try:
+                type = NotificationType(entry.type)
+                change = NotificationChange(entry.change)
+            except ValueError:
+                # unknown codes, see: NotificationEntry
+                continue
+            if type in self.tables:
+                changes[(type, entry.record_id)] = change
+
+        fetching = {}
+        with pipelining(self.harness):
+            for (type, record_id), change in changes.items():
+                if change is NotificationChange.DELETED:
+                    self.__remove(type, record_id)
+                else:
+                    fetching[(type, record_id)] = self.tables[type][2](record_id).submit(self.harness)
+            for (type, record_id), future in fetching.items():
+                try:
+                    self.__put(type, record_id, future.result())
+                except TransactionError as e:
+                    if e.status != Status.NotFound.value:
+                        raise
+                    # removed after notification was sent
+                    self.__remove(type, record_id)
+        self.acknowledge(entries)
+        return len(changes)
+
+    def __put(self, type: NotificationType, record_id: int, response):
+        table = self.tables[type][0]
+        table[record_id] = response.response.body
+
+    def __remove(self, type: NotificationType, record_id: int):
+        table = self.tables[type][0]
+        table.pop(record_id, None)
+        if type is NotificationType.THREAD:
+            # messages of removed thread are removed without notifications
+            self.messages.remove_thread(record_id)
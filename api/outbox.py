@@ -1,30 +1,54 @@
+import asyncio
+import atexit
+import threading
+import weakref
+from concurrent.futures import Future
+from enum import IntEnum
+
+from ..harness import Harness
 from ..request import Request, Response
 from ..interface.defs import Endpoint, Method
+from .. import log
 from .generic import GenericResponse, GenericTransaction
-from enum import Enum
 
 
-class NotificationType(Enum):
+class NotificationType(IntEnum):
     INVALID = 0
     MESSAGE = 1
     THREAD = 2
     CONTACT = 3
 
 
-class NotificationChange(Enum):
+class NotificationChange(IntEnum):
     INVALID = 0
     CREATED = 1
     UPDATED = 2
     DELETED = 3
 
 
+def _typed(enum, value):
+    try:
+        return enum(value)
+    except ValueError:
+        # sent by newer phone software, kept as is
+        return value
+
+
 class NotificationEntry:
     def __init__(self, uid: int, type: NotificationType, change: NotificationChange, record_id: int):
         self.uid = uid
-        self.type = type
-        self.change = change
+        self.type = _typed(NotificationType, type)
+        self.change = _typed(NotificationChange, change)
         self.record_id = record_id
 
+    def matches(self, type: NotificationType = None, change: NotificationChange = None, record_id: int = None):
+        return ((type is None or self.type == type) and (change is None or self.change == change)
+                and (record_id is None or self.record_id == record_id))
+
+    def __repr__(self):
+        return f"NotificationEntry(uid={self.uid}, type={self.type!r}, change={self.change!r}, " \
+               f"record_id={self.record_id})"
+
 
 class NotificationsResponse(GenericResponse):
     def __init__(self, *args, **kwargs):
@@ -38,6 +62,8 @@ class GetNotifications(GenericTransaction):
     """
     Retrieve notifications
     """
+    # polled often, stalled poll shouldn't hold subscriber for long
+    timeout = 10
 
     def __init__(self):
         self.request = Request(Endpoint.OUTBOX, Method.GET, {"category": "entries"})
@@ -50,9 +76,183 @@ class DeleteNotifications(GenericTransaction):
     """
     Delete notifications with specified uid
     """
+    timeout = 10
 
     def __init__(self, entries: list):
         self.request = Request(Endpoint.OUTBOX, Method.DEL, {"entries": entries})
 
     def setResponse(self, response: Response):
         self.response = GenericResponse(response)
+
+
+_subscribers = weakref.WeakSet()
+
+
+@atexit.register
+def _stop_subscribers():
+    # same as port watchers - polling thread must not be killed while logging
+    for subscriber in list(_subscribers):
+        subscriber.stop()
+
+
+class OutboxSubscriber:
+    '''
+    background outbox poller delivering new NotificationEntry objects to subscribers
+        - outbox is polled every min_interval_s after activity, interval grows `backoff` times
+          per idle poll up to max_interval_s
+        - entries are delivered once per uid, even if phone sends them again before acknowledge
+        - delivered uids are acknowledged with DeleteNotifications in batches of ack_batch,
+          or sooner when outbox goes idle
+    pipelining is enabled on harness while subscriber runs, so other requests can be sent from
+    other threads meanwhile, callbacks are called from polling thread
+    use example:
+        with OutboxSubscriber(harness) as outbox:
+            created = outbox.expect(NotificationType.MESSAGE, NotificationChange.CREATED)
+            AddMessage("+48600000000", "hello").run(harness)
+            entry = created.result(timeout=5)
+    '''
+
+    def __init__(self, harness: Harness, min_interval_s=0.05, max_interval_s=2.0, backoff=2.0,
+                 ack_batch: int = 32):
+        self.harness = harness
+        self.min_interval_s = min_interval_s
+        self.max_interval_s = max_interval_s
+        self.backoff = backoff
+        self.ack_batch = ack_batch
+        self.interval_s = min_interval_s
+        self.subscribers = []
+        self.expected = 0
+        self.seen = set()
+        self.to_acknowledge = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.running = False
+        self.thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        if self.running:
+            return self
+        # subscriber's reference keeps pipelining on till stop, whatever other users do
+        self.harness.enable_pipelining()
+        self.running = True
+        self.thread = threading.Thread(target=self.__poll_loop, name=f"outbox {self.harness.port_name}",
+                                       daemon=True)
+        self.thread.start()
+        _subscribers.add(self)
+        return self
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self.wakeup.set()
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+        try:
+            self.__acknowledge()
+        except Exception as e:
+            log.error(f"outbox acknowledge failed: {e!r}")
+        self.harness.disable_pipelining()
+
+    def subscribe(self, callback):
+        '''
+        callback(NotificationEntry) is called for each new entry
+        '''
+        with self.lock:
+            self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            if callback in self.subscribers:
+                self.subscribers.remove(callback)
+
+    def queue(self, loop: asyncio.AbstractEventLoop = None) -> asyncio.Queue:
+        '''
+        asyncio.Queue receiving new entries, to be awaited in loop - running one by default
+        '''
+        loop = loop or asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        self.subscribe(lambda entry: loop.call_soon_threadsafe(queue.put_nowait, entry))
+        return queue
+
+    def expect(self, type: NotificationType = None, change: NotificationChange = None,
+               record_id: int = None) -> Future:
+        '''
+        future resolved with first new entry matching given fields, call it before action which causes it
+        outbox is polled at fastest rate till then
+        '''
+        future = Future()
+
+        def on_entry(entry: NotificationEntry):
+            if entry.matches(type, change, record_id) and not future.done():
+                future.set_result(entry)
+                self.unsubscribe(on_entry)
+
+        def on_done(_):
+            self.unsubscribe(on_entry)
+            with self.lock:
+                self.expected -= 1
+
+        with self.lock:
+            self.expected += 1
+        future.add_done_callback(on_done)
+        self.subscribe(on_entry)
+        self.poll_now()
+        return future
+
+    def poll_now(self):
+        '''
+        poll right away and keep fastest rate, i.e. after action which should cause notification
+        '''
+        self.interval_s = self.min_interval_s
+        self.wakeup.set()
+
+    def __acknowledge(self):
+        with self.lock:
+            uids, self.to_acknowledge = self.to_acknowledge, []
+        if uids:
+            DeleteNotifications(uids).submit(self.harness).result(DeleteNotifications.timeout)
+            with self.lock:
+                # acknowledged entries won't be sent again
+                self.seen.difference_update(uids)
+
+    def __deliver(self, entries: list):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for entry in entries:
+            for callback in subscribers:
+                try:
+                    callback(entry)
+                except Exception as e:
+                    log.error(f"outbox callback failed: {e!r}")
+
+    def __poll(self) -> list:
+        entries = GetNotifications().submit(self.harness).result(GetNotifications.timeout).entries
+        with self.lock:
+            new = [entry for entry in entries if entry.uid not in self.seen]
+            self.seen.update(entry.uid for entry in new)
+            self.to_acknowledge.extend(entry.uid for entry in new)
+            pending = len(self.to_acknowledge)
+        self.__deliver(new)
+        if pending >= self.ack_batch or (pending and not new):
+            self.__acknowledge()
+        return new
+
+    def __poll_loop(self):
+        while self.running:
+            self.wakeup.clear()
+            try:
+                if self.__poll() or self.expected:
+                    self.interval_s = self.min_interval_s
+                else:
+                    self.interval_s = min(self.interval_s * self.backoff, self.max_interval_s)
+            except Exception as e:
+                log.error(f"outbox poll failed: {e!r}")
+                self.interval_s = self.max_interval_s
+            self.wakeup.wait(self.interval_s)
@@ -0,0 +1,72 @@
+from concurrent.futures import Future
+from contextlib import nullcontext
+
+from ..harness import Harness
+from .generic import GenericTransaction, pipelining
+
+'''
+Lazy iteration over entries of offset/limit endpoints, i.e.:
+    for message in Pages(harness, GetMessagesWithOffsetAndLimit):
+        print(message["messageBody"])
+    for message in Pages(harness, lambda offset, limit: GetMessagesByThreadIdWithOffsetAndLimit(threadID, offset, limit)):
+        ...
+'''
+
+
+class Pages:
+    '''
+    iterates over entries of all pages of offset/limit endpoint, fetching them as they are consumed
+        transaction_factory - called with (offset, limit) to create page transaction,
+                              i.e. GetContactsWithOffsetAndLimit
+        limit - requested page size, phone can send smaller pages
+        prefetch - request page N+1 while page N is consumed, with pipelining enabled for iteration time
+    follows nextPage sent by phone, without it offset is moved by number of entries received till totalCount
+    at most two pages are held in memory at once
+    '''
+    def __init__(self, harness: Harness, transaction_factory, limit: int = 50, offset: int = 0, prefetch=True):
+        self.harness = harness
+        self.transaction_factory = transaction_factory
+        self.limit = limit
+        self.offset = offset
+        self.prefetch = prefetch
+        self.totalCount = None
+
+    def __submit(self, offset: int, limit: int) -> Future:
+        transaction: GenericTransaction = self.transaction_factory(offset, limit)
+        return transaction.submit(self.harness)
+
+    def __next_page(self, body: dict, offset: int, limit: int):
+        '''
+        returns (offset, limit) of page following the one with body, None if it was the last one
+        '''
+        if "nextPage" in body:
+            return body["nextPage"]["offset"], body["nextPage"]["limit"]
+        received = len(body["entries"])
+        if received == 0 or offset + received >= body["totalCount"]:
+            return None
+        return offset + received, limit
+
+    def __pages(self):
+        page = (self.offset, self.limit)
+        pending = self.__submit(*page)
+        while pending is not None:
+            body = pending.result().response.body
+            self.totalCount = body["totalCount"]
+            page = self.__next_page(body, *page)
+            pending = None
+            if page is not None and self.prefetch:
+                pending = self.__submit(*page)
+            yield body["entries"]
+            if page is not None and not self.prefetch:
+                pending = self.__submit(*page)
+
+    def pages(self):
+        '''
+        iterate over whole pages (lists of entries) instead of entries
+        '''
+        with pipelining(self.harness) if self.prefetch else nullcontext():
+            yield from self.__pages()
+
+    def __iter__(self):
+        for entries in self.pages():
+            yield from entries
@@ -0,0 +1,453 @@
+# Copyright (c) 2017-2021, Mudita Sp. z.o.o. All rights reserved.
+# For licensing, see https://github.com/mudita/MuditaOS/LICENSE.md
+import base64
+import itertools
+import os
+import select
+import threading
+import time
+import tty
+import zlib
+
+from . import log
+from .interface import codec
+from .interface.defs import Endpoint, Method, Status
+from .interface.error import ComError
+from .interface.framing import header_length, parse_header
+
+'''
+Pure python stand-in for MuditaOS service-desktop, served on pseudo-terminal.
+Endpoints are implemented on in-memory stores, so harness can be benchmarked without a phone.
+
+usage:
+    with ServiceDesktopEmulator(latency_s=0.005) as emulator:
+        harness = Harness(emulator.port_name)
+or to be found by `get_harness_by_port_name("simulator", ...)`:
+    python3 -m harness.emulator --latency 0.005
+'''
+
+
+class EmulatorState:
+    '''
+    in-memory device state, can be seeded and inspected by tests directly
+    '''
+    def __init__(self, chunk_size=4096):
+        self.chunk_size = chunk_size
+        self.contacts = {}
+        self.threads = {}
+        self.messages = {}
+        self.templates = {}
+        self.calllog = {}
+        self.files = {}
+        self.outbox = {}
+        self.transfers = {}
+        self.keys = []
+        self.focus = "ApplicationDesktop"
+        self.phone_locked = False
+        self.dom = {"Window": {"Children": []}}
+        self.device_info = {
+            "deviceModel": "Emulator",
+            "serialNumber": "000000000000",
+            "osVersion": "0.0.0",
+            "batteryLevel": "100",
+        }
+        self.ids = itertools.count(1)
+
+    def next_id(self) -> int:
+        return next(self.ids)
+
+    def notify(self, type: int, change: int, record_id: int):
+        uid = self.next_id()
+        self.outbox[uid] = {"uid": uid, "type": type, "change": change, "record_id": record_id}
+
+
+def page(entries: list, body: dict) -> dict:
+    offset = body.get("offset", 0)
+    limit = body.get("limit", len(entries))
+    result = {"entries": entries[offset:offset + limit], "totalCount": len(entries)}
+    if offset + limit < len(entries):
+        result["nextPage"] = {"offset": offset + limit, "limit": limit}
+    return result
+
+
+class Emulator:
+    '''
+    service-desktop request handler: request dict -> (status, body)
+    '''
+    notification_message = 1
+    notification_thread = 2
+    notification_contact = 3
+
+    created = 1
+    updated = 2
+    deleted = 3
+
+    def __init__(self, state: EmulatorState = None):
+        self.state = state if state is not None else EmulatorState()
+        self.handlers = {
+            Endpoint.DEVICEINFO: self.device_info,
+            Endpoint.UPDATE: self.accepted,
+            Endpoint.FILESYSTEM: self.filesystem,
+            Endpoint.BACKUP: self.accepted,
+            Endpoint.RESTORE: self.accepted,
+            Endpoint.FACTORY: self.factory,
+            Endpoint.CONTACTS: self.contacts,
+            Endpoint.MESSAGES: self.messages,
+            Endpoint.CALLLOG: self.calllog,
+            Endpoint.DEVELOPERMODE: self.developer_mode,
+            Endpoint.USBSECURITY: self.usb_security,
+            Endpoint.OUTBOX: self.outbox,
+        }
+
+    def handle(self, request: dict):
+        try:
+            handler = self.handlers[Endpoint(request["endpoint"])]
+            return handler(Method(request["method"]), request.get("body", {}))
+        except (KeyError, ValueError, TypeError) as e:
+            log.debug(f"emulator bad request {request}: {e!r}")
+            return Status.BadRequest, {}
+
+    def accepted(self, method: Method, body: dict):
+        return Status.Accepted, {}
+
+    def device_info(self, method: Method, body: dict):
+        if "fileList" in body:
+            return Status.OK, {"files": []}
+        return Status.OK, dict(self.state.device_info)
+
+    def factory(self, method: Method, body: dict):
+        return Status.OK, {"factoryRequest": True}
+
+    def developer_mode(self, method: Method, body: dict):
+        # CDCSerial sends focus, phoneLocked and key presses with PUT
+        state = self.state
+        if "focus" in body:
+            return Status.OK, {"focus": state.focus}
+        if "phoneLocked" in body:
+            return Status.OK, {"phoneLocked": state.phone_locked}
+        if "ui" in body:
+            return Status.OK, {"dom": state.dom}
+        if "log" in body and method == Method.GET:
+            return Status.OK, {"level": 0}
+        if "keyPressed" in body:
+            state.keys.append((body["keyPressed"], body["state"]))
+            return Status.OK, {}
+        if "AT" in body:
+            return Status.OK, {"ATResponse": ["OK"]}
+        return Status.NoContent, {}
+
+    def usb_security(self, method: Method, body: dict):
+        if method == Method.PUT:
+            self.state.phone_locked = False
+            return Status.NoContent, {}
+        if body.get("category") == "phoneLockTime":
+            return Status.OK, {"phoneLockTime": 0, "timeLeftToNextAttempt": 0}
+        return Status.NoContent if not self.state.phone_locked else Status.Forbidden, {}
+
+    def outbox(self, method: Method, body: dict):
+        if method == Method.GET:
+            return Status.OK, {"entries": list(self.state.outbox.values())}
+        for uid in body["entries"]:
+            self.state.outbox.pop(uid, None)
+        return Status.NoContent, {}
+
+    def contacts(self, method: Method, body: dict):
+        contacts = self.state.contacts
+        if method == Method.GET:
+            if "count" in body:
+                return Status.OK, {"count": len(contacts)}
+            if "id" in body:
+                if body["id"] not in contacts:
+                    return Status.NotFound, {}
+                return Status.OK, contacts[body["id"]]
+            return Status.OK, page(list(contacts.values()), body)
+        if method == Method.POST:
+            for contact in contacts.values():
+                if set(contact.get("numbers", [])) & set(body.get("numbers", [])):
+                    return Status.Conflict, {"id": contact["id"]}
+            id = self.state.next_id()
+            contacts[id] = dict(body, id=id)
+            self.state.notify(self.notification_contact, self.created, id)
+            return Status.OK, {"id": id}
+        if body.get("id") not in contacts:
+            return Status.NotFound, {}
+        if method == Method.PUT:
+            contacts[body["id"]].update(body)
+            self.state.notify(self.notification_contact, self.updated, body["id"])
+            return Status.NoContent, {}
+        del contacts[body["id"]]
+        self.state.notify(self.notification_contact, self.deleted, body["id"])
+        return Status.NoContent, {}
+
+    def calllog(self, method: Method, body: dict):
+        calllog = self.state.calllog
+        if method == Method.GET:
+            if "count" in body:
+                return Status.OK, {"count": len(calllog)}
+            if "id" in body:
+                if body["id"] not in calllog:
+                    return Status.NotFound, {}
+                return Status.OK, calllog[body["id"]]
+            return Status.OK, page(list(calllog.values()), body)
+        if calllog.pop(body.get("id"), None) is None:
+            return Status.NotFound, {}
+        return Status.NoContent, {}
+
+    def messages(self, method: Method, body: dict):
+        category = {
+            "thread": self.message_threads,
+            "message": self.message_messages,
+            "template": self.message_templates,
+        }[body["category"]]
+        return category(method, body)
+
+    def message_threads(self, method: Method, body: dict):
+        threads = self.state.threads
+        if method == Method.GET:
+            if "threadID" in body:
+                if body["threadID"] not in threads:
+                    return Status.NotFound, {}
+                if "isUnread" in body:
+                    threads[body["threadID"]]["isUnread"] = body["isUnread"]
+                    return Status.NoContent, {}
+                return Status.OK, threads[body["threadID"]]
+            return Status.OK, page(list(threads.values()), body)
+        if threads.pop(body.get("threadID"), None) is None:
+            return Status.NotFound, {}
+        for id in [id for id, message in self.state.messages.items() if message["threadID"] == body["threadID"]]:
+            del self.state.messages[id]
+        self.state.notify(self.notification_thread, self.deleted, body["threadID"])
+        return Status.NoContent, {}
+
+    def __thread_for(self, number: str) -> dict:
+        for thread in self.state.threads.values():
+            if thread["number"] == number:
+                return thread
+        id = self.state.next_id()
+        thread = {"threadID": id, "number": number, "contactID": 0, "isUnread": False, "messageCount": 0,
+                  "messageSnippet": "", "messageType": 0, "lastUpdatedAt": 0}
+        self.state.threads[id] = thread
+        self.state.notify(self.notification_thread, self.created, id)
+        return thread
+
+    def message_messages(self, method: Method, body: dict):
+        messages = self.state.messages
+        if method == Method.GET:
+            if "count" in body:
+                return Status.OK, {"count": len(messages)}
+            if "messageID" in body:
+                if body["messageID"] not in messages:
+                    return Status.NotFound, {}
+                return Status.OK, messages[body["messageID"]]
+            entries = list(messages.values())
+            if "threadID" in body:
+                entries = [message for message in entries if message["threadID"] == body["threadID"]]
+            return Status.OK, page(entries, body)
+        if method == Method.POST:
+            thread = self.__thread_for(body["number"])
+            id = self.state.next_id()
+            message = {"messageID": id, "threadID": thread["threadID"], "number": body["number"],
+                       "messageBody": body["messageBody"], "messageType": body.get("messageType", 0x08),
+                       "contactID": thread["contactID"], "createdAt": int(time.time())}
+            messages[id] = message
+            thread.update({"messageCount": thread["messageCount"] + 1, "messageSnippet": body["messageBody"],
+                           "messageType": message["messageType"], "lastUpdatedAt": message["createdAt"]})
+            self.state.notify(self.notification_message, self.created, id)
+            self.state.notify(self.notification_thread, self.updated, thread["threadID"])
+            return Status.OK, message
+        if body.get("messageID") not in messages:
+            return Status.NotFound, {}
+        if method == Method.PUT:
+            messages[body["messageID"]]["messageBody"] = body["messageBody"]
+            self.state.notify(self.notification_message, self.updated, body["messageID"])
+            return Status.NoContent, {}
+        del messages[body["messageID"]]
+        self.state.notify(self.notification_message, self.deleted, body["messageID"])
+        return Status.NoContent, {}
+
+    def message_templates(self, method: Method, body: dict):
+        templates = self.state.templates
+        if method == Method.GET:
+            if "count" in body:
+                return Status.OK, {"count": len(templates)}
+            if "templateID" in body:
+                if body["templateID"] not in templates:
+                    return Status.NotFound, {}
+                return Status.OK, templates[body["templateID"]]
+            return Status.OK, page(sorted(templates.values(), key=lambda t: t["order"]), body)
+        if method == Method.POST:
+            id = self.state.next_id()
+            templates[id] = {"templateID": id, "templateBody": body["templateBody"], "lastUsedAt": 0,
+                             "order": len(templates) + 1}
+            return Status.OK, {"templateID": id}
+        if body.get("templateID") not in templates:
+            return Status.NotFound, {}
+        if method == Method.PUT:
+            for key in ("templateBody", "order"):
+                if key in body:
+                    templates[body["templateID"]][key] = body[key]
+            return Status.NoContent, {}
+        del templates[body["templateID"]]
+        return Status.NoContent, {}
+
+    def filesystem(self, method: Method, body: dict):
+        state = self.state
+        files = state.files
+        if method == Method.GET:
+            if "listDir" in body:
+                prefix = body["listDir"].rstrip("/") + "/"
+                return Status.OK, {body["listDir"]: [{"path": path, "fileSize": len(data), "type": 1}
+                                                     for path, data in files.items() if path.startswith(prefix)]}
+            if "fileName" in body:
+                if body["fileName"] not in files:
+                    return Status.NotFound, {}
+                data = bytes(files[body["fileName"]])
+                rxID = state.next_id()
+                state.transfers[rxID] = data
+                return Status.OK, {"rxID": rxID, "fileSize": len(data), "chunkSize": state.chunk_size,
+                                   "fileCrc32": format(zlib.crc32(data) & 0xFFFFFFFF, '08x')}
+            if body.get("rxID") not in state.transfers:
+                return Status.BadRequest, {}
+            data = state.transfers[body["rxID"]]
+            start = (body["chunkNo"] - 1) * state.chunk_size
+            if body["chunkNo"] < 1 or start >= len(data):
+                return Status.BadRequest, {}
+            # device appends single not base64 character to data
+            result = {"rxID": body["rxID"], "chunkNo": body["chunkNo"],
+                      "data": base64.standard_b64encode(data[start:start + state.chunk_size]).decode() + "\n"}
+            if start + state.chunk_size >= len(data):
+                result["fileCrc32"] = format(zlib.crc32(data) & 0xFFFFFFFF, '08x')
+            return Status.OK, result
+        if method == Method.DEL:
+            if files.pop(body["removeFile"], None) is None:
+                return Status.NotFound, {}
+            return Status.NoContent, {}
+        if "renameFile" in body:
+            if body["renameFile"] not in files:
+                return Status.NotFound, {}
+            files[body["destFilename"]] = files.pop(body["renameFile"])
+            return Status.NoContent, {}
+        if "fileName" in body:
+            txID = state.next_id()
+            state.transfers[txID] = {"fileName": body["fileName"], "fileSize": body["fileSize"],
+                                     "fileCrc32": body["fileCrc32"], "data": bytearray(), "chunkNo": 0}
+            return Status.OK, {"txID": txID, "chunkSize": state.chunk_size}
+        transfer = state.transfers.get(body.get("txID"))
+        if not isinstance(transfer, dict) or body["chunkNo"] != transfer["chunkNo"] + 1:
+            return Status.BadRequest, {}
+        transfer["data"] += base64.standard_b64decode(body["data"])
+        transfer["chunkNo"] = body["chunkNo"]
+        if len(transfer["data"]) >= transfer["fileSize"]:
+            del state.transfers[body["txID"]]
+            if format(zlib.crc32(transfer["data"]) & 0xFFFFFFFF, '08x') != transfer["fileCrc32"]:
+                return Status.NotAcceptable, {}
+            files[transfer["fileName"]] = bytes(transfer["data"])
+        return Status.OK, {"txID": body["txID"], "chunkNo": body["chunkNo"]}
+
+
+class ServiceDesktopEmulator:
+    '''
+    serves Emulator on pseudo-terminal, harness connects to `port_name`
+        latency_s - time to process each request
+        bandwidth_Bps - link throughput in bytes per second both ways, None for unlimited
+        pts_name_file - file to publish port name in, as MuditaOS Linux simulator does
+    '''
+    pts_name_file = "/tmp/purephone_pts_name"
+    # limits time needed to stop serving
+    poll_time_s = 0.1
+
+    def __init__(self, latency_s=0.0, bandwidth_Bps=None, state: EmulatorState = None, publish=False):
+        self.latency_s = latency_s
+        self.bandwidth_Bps = bandwidth_Bps
+        self.emulator = Emulator(state)
+        self.state = self.emulator.state
+        self.publish = publish
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port_name = os.ttyname(self.slave)
+        self.running = False
+        self.thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        if self.publish:
+            with open(self.pts_name_file, "w") as file:
+                file.write(self.port_name)
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, name=f"emulator {self.port_name}", daemon=True)
+        self.thread.start()
+        log.info(f"service-desktop emulator on {self.port_name}")
+
+    def stop(self):
+        self.running = False
+        if self.publish and os.path.exists(self.pts_name_file):
+            os.remove(self.pts_name_file)
+        if self.thread is not None:
+            self.thread.join()
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def __throttle(self, length: int):
+        if self.bandwidth_Bps:
+            time.sleep(length / self.bandwidth_Bps)
+
+    def respond(self, request: dict):
+        time.sleep(self.latency_s)
+        status, body = self.emulator.handle(request)
+        payload = codec.dumps({"endpoint": request.get("endpoint"), "status": status.value,
+                               "uuid": request.get("uuid"), "body": body})
+        frame = b"#%09d%s" % (len(payload), payload)
+        self.__throttle(len(frame))
+        view = memoryview(frame)
+        while view:
+            view = view[os.write(self.master, view):]
+
+    def serve(self):
+        buffer = bytearray()
+        while self.running:
+            try:
+                readable, _, _ = select.select([self.master], [], [], self.poll_time_s)
+                if not readable:
+                    continue
+                data = os.read(self.master, 65536)
+            except OSError:
+                break
+            self.__throttle(len(data))
+            buffer += data
+            while len(buffer) >= header_length:
+                try:
+                    length = parse_header(buffer[:header_length])
+                except ComError as e:
+                    log.error(f"emulator dropping input: {e}")
+                    buffer.clear()
+                    break
+                if len(buffer) < header_length + length:
+                    break
+                request = codec.loads(bytes(buffer[header_length:header_length + length]))
+                del buffer[:header_length + length]
+                self.respond(request)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="MuditaOS service-desktop emulator")
+    parser.add_argument("--latency", type=float, default=0.0, help="request processing time [s]")
+    parser.add_argument("--bandwidth", type=int, default=None, help="link throughput [B/s]")
+    args = parser.parse_args()
+    emulator = ServiceDesktopEmulator(args.latency, args.bandwidth, publish=True)
+    emulator.start()
+    try:
+        emulator.thread.join()
+    except KeyboardInterrupt:
+        emulator.stop()
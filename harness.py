@@ -1,16 +1,17 @@
 # Copyright (c) 2017-2021, Mudita Sp. z.o.o. All rights reserved.
 # For licensing, see https://github.com/mudita/MuditaOS/LICENSE.md
-import random
+import asyncio
+from concurrent.futures import Future
 
 from . import utils
 from . import log
 
 from .utils import send_keystoke
 from .utils import application_keypath
-from .utils import send_char
-from .utils import clear_last_char
 
 from .interface import CDCSerial as serial
+from .interface.AsyncCDCSerial import AsyncCDCSerial
+from .interface.pacing import KeyPacing
 
 from .interface.error import TestError
 from .interface.error import Error
@@ -34,6 +35,7 @@ class Harness:
     def __init__(self, port):
         self.port_name = port
         self.connection = serial.CDCSerial(port)
+        self.async_connection = None
         self.phone_mode_lock = False
 
     @classmethod
@@ -52,9 +54,21 @@ class Harness:
     def get_connection(self):
         return self.connection
 
+    def subscribe_port_state(self, callback):
+        '''
+        get notified about phone reset, callback(PortState) is called from port watcher thread
+        '''
+        self.connection.subscribe_port_state(callback)
+
     def set_connection(self, connection):
         Harness.connection = connection
         self.connection = connection
+        self.async_connection = None
+
+    def get_async_connection(self) -> AsyncCDCSerial:
+        if self.async_connection is None:
+            self.async_connection = AsyncCDCSerial(self.connection)
+        return self.async_connection
 
     def get_application_name(self):
         return self.connection.get_application_name()
@@ -68,9 +82,19 @@ class Harness:
     def is_phone_mode_locked(self):
         return self.phone_mode_lock
 
-    def enter_passcode(self, pin=default_pin):
+    def set_key_pacing(self, pacing: KeyPacing):
+        '''
+        select how long to wait between key presses, i.e.:
+            harness.set_key_pacing(AdaptiveKeyPacing(min_interval_s=0.05))
+        '''
+        self.connection.set_key_pacing(pacing)
+
+    def enter_passcode(self, pin=default_pin, burst=False):
         utils.validate_pin(pin)
         if self.connection.is_phone_locked():
+            if burst:
+                self.send_key_sequence(["enter", "#"] + list(pin))
+                return
             self.connection.send_key_code(key_codes["enter"])
             self.connection.send_key_code(key_codes["#"])
             for digit in pin:
@@ -112,28 +136,59 @@ class Harness:
         if self.connection.disable_echo_mode():
             self.is_echo_mode = False
 
-    def open_application(self, app):
+    def open_application(self, app, burst=False):
+        if burst:
+            self.send_key_sequence(application_keypath[app])
+            return
         send_keystoke(application_keypath[app], self.connection)
 
-    def send_text(self, text: str):
-        clear_last_char()
-        for letter in text:
-            try:
-                send_char(letter, self.connection)
-            except KeyError as e:
-                available = ' '.join((f"'{_}'" for _ in utils.keymap.keys()))
-                raise LookupError(f"Character {e} not present in the keymap\nAvailable characters: {available}")
-
-    def send_number(self, number: str):
+    def plan_text(self, text: str) -> utils.KeyPlan:
+        '''
+        compile text to key program without sending it, i.e. to check key count and estimated time
+        '''
+        try:
+            return utils.compile_text(text)
+        except KeyError as e:
+            available = ' '.join((f"'{_}'" for _ in utils.keymap.keys()))
+            raise LookupError(f"Character {e} not present in the keymap\nAvailable characters: {available}")
+
+    def send_text(self, text: str, burst=False):
+        plan = self.plan_text(text)
+        log.info(f"typing {len(text)} characters with {plan.key_count} keys, "
+                 f"estimated {plan.estimated_time(self.connection.key_pacing.interval_s):.1f}s")
+        if burst:
+            self.send_key_sequence(list(plan.keys))
+            return
+        for key_code, key_type in plan.keys:
+            self.connection.send_key_code(key_code, key_type)
+
+    def send_number(self, number: str, burst=False):
+        if burst:
+            if number.isnumeric():
+                self.send_key_sequence([int(digit) for digit in number])
+            return
         utils.send_number(number, self.connection)
 
-    def request(self, endpoint: Endpoint, method: Method, data: dict) -> Transaction:
+    def send_key_sequence(self, keys, spacing_s=0) -> list:
+        '''
+        send keys as single pipelined burst - costs about one round trip instead of one per key
+            keys - list of key names, key codes or (key_code, Keytype), see: utils.key_sequence
+            spacing_s - optional wait between key presses, if UI drops keys sent too fast
+        returns list of key press responses
+        use example:
+            harness.send_key_sequence(application_keypath["messages"])
+            harness.send_key_sequence([(key_codes["fnRight"], Keytype.long_press)])
+        '''
+        return self.connection.send_key_sequence(utils.key_sequence(keys), spacing_s)
+
+    def request(self, endpoint: Endpoint, method: Method, data: dict, timeout=60) -> Transaction:
         '''
         sends data to device and gets response
         the same as endpoint_request except:
             - works on types
             - throws in case of error
-            - provides execution time
+            - provides execution time, with per phase breakdown in Transaction.get_timings()
+        timeout - deadline in seconds of whole request, ComTimeout is raised when it passes, None - no deadline
         use example:
         ```
             body = {"txID": txID, "chunkNo": chunkNo, "data": data}
@@ -141,23 +196,90 @@ class Harness:
             assert ret.response.body["txID"] != 0
         ```
         '''
-        t = Transaction(Request(endpoint.value, method.value, data, random.randint(1, 32000)))
-        t.accept(self.connection.write(t.request.to_dict()))
-        r, w = self.connection.get_timing()
-        r = r.elapsed()
-        w = w.elapsed()
-        t.set_elapsed(r, w)
+        t = Transaction(Request(endpoint.value, method.value, data, self.connection.next_uuid()))
+        t.accept(self.connection.write(t.request.to_message(), timeout, t.timings))
+        t.set_elapsed(t.timings.send_time(), t.timings.read_time())
+        return t
+
+    def enable_pipelining(self):
+        '''
+        allow many requests in flight at once, see: request_nowait
+        has to be matched with disable_pipelining, see: CDCSerial.enable_pipelining
+        '''
+        self.connection.enable_pipelining()
+
+    def disable_pipelining(self):
+        self.connection.disable_pipelining()
+
+    def request_nowait(self, endpoint: Endpoint, method: Method, data: dict, timeout=60) -> Future:
+        '''
+        sends data to device without waiting for response
+        returns future resolved with Transaction the same as `request` returns
+        timeout - deadline in seconds of the request, future fails with ComTimeout when it passes
+        with pipelining enabled many requests can be in flight at once:
+        ```
+            harness.enable_pipelining()
+            pending = [harness.request_nowait(Endpoint.CONTACTS, Method.GET, {"id": id}) for id in ids]
+            contacts = [p.result().response.body for p in pending]
+        ```
+        '''
+        t = Transaction(Request(endpoint.value, method.value, data, self.connection.next_uuid()))
+        msg = t.request.to_message()
+        pending = self.connection.submit(msg, t.timings, timeout)
+        t.request.uuid = msg["uuid"]
+        result = Future()
+
+        def on_response(future: Future):
+            try:
+                t.accept(future.result())
+                t.set_elapsed(t.timings.send_time(), t.timings.read_time())
+                result.set_result(t)
+            except Exception as e:
+                result.set_exception(e)
+
+        pending.add_done_callback(on_response)
+        return result
+
+    async def request_async(self, endpoint: Endpoint, method: Method, data: dict, timeout=60) -> Transaction:
+        '''
+        asyncio equivalent of request, awaits response without blocking event loop
+        use example:
+        ```
+            ret = await harness.request_async(Endpoint.DEVICEINFO, Method.GET, {})
+        ```
+        '''
+        t = Transaction(Request(endpoint.value, method.value, data, self.connection.next_uuid()))
+        t.accept(await self.__write_async(t.request.to_message(), timeout, t.timings))
+        t.set_elapsed(t.timings.send_time(), t.timings.read_time())
         return t
 
-    def endpoint_request(self, ep_name: str, met: str, body: dict) -> dict:
+    def endpoint_request(self, ep_name: str, met: str, body: dict, timeout=60) -> dict:
         ret = self.connection.write({
             "endpoint": endpoint[ep_name],
             "method": method[met],
-            "uuid": random.randint(1, 32000),
+            "uuid": self.connection.next_uuid(),
+            "body": body
+        }, timeout)
+        return ret
+
+    async def endpoint_request_async(self, ep_name: str, met: str, body: dict, timeout=60) -> dict:
+        ret = await self.__write_async({
+            "endpoint": endpoint[ep_name],
+            "method": method[met],
+            "uuid": self.connection.next_uuid(),
             "body": body
-        })
+        }, timeout)
         return ret
 
+    async def __write_async(self, msg, timeout, timings=None):
+        '''
+        with pipelining on, its reader thread owns the port - request goes through pipeline
+        and its future is awaited, AsyncCDCSerial reading port directly would take pipeline's frames
+        '''
+        if self.connection.is_pipelined():
+            return await asyncio.wrap_future(self.connection.submit(msg, timings, timeout))
+        return await self.get_async_connection().write(msg, timeout, timings)
+
     def turn_phone_off(self):
         log.info("Turning phone off...")
         app_desktop = "ApplicationDesktop"
@@ -1,10 +1,37 @@
+import os
+import threading
+
 from .harness import Harness
 from . import log
-from .utils import Timeout
+from .interface.deadline import Deadline, Timeout
 from .rt_harness_discovery import get_harness_automatic, get_harness_by_port_name
 from .api.update import PhoneReboot, Reboot
 from .api.developermode import PhoneModeLock
-from .interface.error import ComError
+from .interface.CDCSerial import CDCSerial
+from .interface.error import ComError, Error, TestError
+
+
+class HarnessSession:
+    '''
+    cached harness session of single device, identified by key:
+    USB serial number if device has one, port name otherwise
+    USB serial number lets to find device again when it comes back on other port after reboot
+    '''
+    def __init__(self, key: str, port: str, serial_number: str = None):
+        self.key = key
+        self.port = port
+        self.serial_number = serial_number
+        self.harness: Harness = None
+        self.timeout = None
+        self.retry_time_s = None
+        self.lock = threading.RLock()
+
+    def current_port(self) -> str:
+        if self.serial_number is not None:
+            port = CDCSerial.find_port(self.serial_number)
+            if port is not None:
+                return port
+        return self.port
 
 
 class HarnessCache:
@@ -12,83 +39,149 @@ class HarnessCache:
     harness session cache, to be used to:
         - create phone harness session
         - reset phone and create session
+    sessions of many devices can be cached at once, selected with `key`
+    (port or USB serial number), without `key` the last created session is used
+    operations on different devices can run in parallel threads
     '''
     harness: Harness = None
+    sessions = {}
+    default_key = None
+    sessions_lock = threading.Lock()
+
+    @classmethod
+    def session(cls, key: str = None) -> HarnessSession:
+        key = cls.default_key if key is None else key
+        with cls.sessions_lock:
+            if key not in cls.sessions:
+                raise ValueError(f"No harness in cache for {key}")
+            return cls.sessions[key]
+
+    @classmethod
+    def keys(cls) -> list:
+        with cls.sessions_lock:
+            return list(cls.sessions.keys())
+
+    @classmethod
+    def cached(cls, key: str = None) -> bool:
+        key = cls.default_key if key is None else key
+        with cls.sessions_lock:
+            return key in cls.sessions and cls.sessions[key].harness is not None
 
     @classmethod
-    def cached(cls) -> bool:
-        return True if cls.harness is not None else False
+    def __get_session(cls, port: str, key: str = None) -> HarnessSession:
+        serial_number = CDCSerial.find_serial_number(port)
+        if key is None:
+            key = serial_number if serial_number is not None else port
+        with cls.sessions_lock:
+            if key not in cls.sessions:
+                cls.sessions[key] = HarnessSession(key, port, serial_number)
+            return cls.sessions[key]
 
     @classmethod
-    def is_operational(cls) -> bool:
+    def is_operational(cls, key: str = None) -> bool:
         '''
         Check with timeout if endpoint is initialized by sending request that we are
         sure that exists and will have response
         '''
         # Timeout which is a max value to request data, it should happen in few seconds
         operational_timeout = 305
-        if cls.harness is None:
+        harness = cls.session(key).harness
+        if harness is None:
             raise ValueError("No harness in cache")
+        return cls.__is_operational(harness, operational_timeout)
+
+    @staticmethod
+    def __is_operational(harness: Harness, operational_timeout) -> bool:
         testbody = {"ui": True, "getWindow": True}
         result = None
         with Timeout.limit(seconds=operational_timeout):
             while not result:
                 try:
-                    result = cls.harness.endpoint_request("developerMode", "get", testbody)
+                    result = harness.endpoint_request("developerMode", "get", testbody)
                     return True
                 except (ValueError, ComError):
                     log.info("Endpoints not ready..")
                     return False
 
     @classmethod
-    def get(cls, port: str, timeout: int, retry_time_s: int, retries=1) -> Harness:
+    def get(cls, port: str, timeout: int, retry_time_s: int, retries=1, key: str = None) -> Harness:
         '''
         depending on `port` get either selected port or discover pure automatically
+        session is cached under `key`, USB serial number or port by default
+        without `port`, device of not cached `key` is looked up by it, TestError is raised if it's not connected
         '''
-        cls.timeout = timeout
-        cls.retry_time_s = retry_time_s
-        cls.port = port
+        harness = None
+        session = None
+        if port is None and key is not None:
+            if key in cls.keys():
+                session = cls.session(key)
+                port = session.port
+            else:
+                # automatic detection could return other device
+                port = key if os.path.exists(key) else CDCSerial.find_port(key)
+                if port is None:
+                    log.error(f"device {key} not connected")
+                    raise TestError(Error.PORT_NOT_FOUND)
 
         with Timeout.limit(seconds=timeout):
             while retries > 0:
                 retries = retries - 1
                 if port is None:
                     log.info("no port provided! trying automatic detection")
-                    HarnessCache.harness = get_harness_automatic(cls.timeout, cls.retry_time_s)
+                    harness = get_harness_automatic(timeout, retry_time_s)
                 else:
+                    if session is not None:
+                        port = session.current_port()
                     log.info(f"port provided {port}")
-                    HarnessCache.harness = get_harness_by_port_name(cls.port, cls.timeout, cls.retry_time_s)
-                if HarnessCache.is_operational() is not True:
-                    cls.harness = None
+                    harness = get_harness_by_port_name(port, timeout, retry_time_s)
+                if cls.__is_operational(harness, 305) is not True:
+                    harness = None
                     if retries == 0:
                         raise ValueError("harness not ready for use")
                 else:
                     break
-                import time
-                time.sleep(cls.retry_time_s)
-        if cls.harness is None:
+                Deadline.sleep(retry_time_s)
+        if harness is None:
             raise ValueError("port not found!")
-        return cls.harness
+
+        if session is None:
+            session = cls.__get_session(harness.port_name, key)
+        with session.lock:
+            session.harness = harness
+            session.port = harness.port_name
+            session.timeout = timeout
+            session.retry_time_s = retry_time_s
+        cls.default_key = session.key
+        cls.harness = harness
+        cls.port = port
+        cls.timeout = timeout
+        cls.retry_time_s = retry_time_s
+        return harness
 
     @classmethod
-    def reset_phone(cls, reboot_cause: Reboot, reboot_time=6 * 60) -> Harness:
+    def reset_phone(cls, reboot_cause: Reboot, reboot_time=6 * 60, key: str = None) -> Harness:
         '''
         Reset the phone flow:
             * reboot_time - time we wait till we say that reboot failed = 6 min default
             * time_to_reboot - time we wait till phone accepts reboot request and closes itself = 60s default
             * reboot_cause - we can reboot to updater, or any other selected in Reboot enum
+            * key - device to reset, the last cached one by default
         '''
         time_to_reboot = 60
-        if cls.harness is None:
-            raise ValueError("No harness in cache")
+        session = cls.session(key)
+        with session.lock:
+            if session.harness is None:
+                raise ValueError("No harness in cache")
+            harness = session.harness
 
-        PhoneReboot(reboot_cause).run(cls.harness)
-        if not cls.harness.connection.watch_port_reboot(time_to_reboot):
-            raise ValueError(f"Phone not rebooted in {reboot_time}")
-        cls.harness = cls.get(cls.port, reboot_time, retry_time_s=1, retries=30)
+            PhoneReboot(reboot_cause).run(harness)
+            if not harness.connection.watch_port_reboot(time_to_reboot):
+                raise ValueError(f"Phone not rebooted in {reboot_time}")
+            session.harness = None
+            harness = cls.get(None, reboot_time, retry_time_s=1, retries=30, key=session.key)
 
-        if not cls.harness.is_phone_locked():
-            cls.harness.unlock_phone()
-        PhoneModeLock(cls.harness.is_phone_mode_locked()).run(cls.harness)
+            if not harness.is_phone_locked():
+                harness.unlock_phone()
+            PhoneModeLock(harness.is_phone_mode_locked()).run(harness)
 
-        return cls.harness
+        return harness
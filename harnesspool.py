@@ -0,0 +1,120 @@
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+from dataclasses import dataclass
+
+from .harness import Harness
+from . import log
+from .interface.CDCSerial import CDCSerial
+from .interface.error import TestError, Error
+
+
+@dataclass
+class PoolResult:
+    '''
+    result of operation on single device of the pool, either value or error is set
+    '''
+    port: str
+    value: object = None
+    error: Exception = None
+
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class HarnessPool:
+    '''
+    drives many phones in parallel from one process, with one worker thread per device
+    operations on one device are executed in order, operations on different devices at once
+    use example:
+        with HarnessPool.from_detect() as pool:
+            results = pool.run(GetDeviceInfo)
+            for port, result in results.items():
+                print(port, result.value.diag_info if result.ok() else result.error)
+    '''
+    def __init__(self, ports: list):
+        self.harnesses = {}
+        self.workers = {}
+        self.failed = {}
+        opening = {}
+        for port in ports:
+            self.workers[port] = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"pool {port}")
+            opening[port] = self.workers[port].submit(Harness, port)
+        for port, future in opening.items():
+            try:
+                self.harnesses[port] = future.result()
+            except Exception as e:
+                log.error(f"can't open {port}: {e!r}")
+                self.failed[port] = e
+                self.workers.pop(port).shutdown(wait=False)
+
+    @classmethod
+    def from_detect(cls):
+        '''
+        open every device found connected to the system
+        '''
+        found = CDCSerial.find_Devices()
+        if not found:
+            raise TestError(Error.PORT_NOT_FOUND)
+        return cls(found)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.harnesses)
+
+    def ports(self) -> list:
+        return list(self.harnesses.keys())
+
+    def get(self, port: str) -> Harness:
+        return self.harnesses[port]
+
+    def close(self):
+        for worker in self.workers.values():
+            worker.shutdown(wait=True)
+        self.workers = {}
+        self.harnesses = {}
+
+    def submit(self, port: str, func) -> Future:
+        '''
+        queue func(harness) on worker of selected device
+        '''
+        return self.workers[port].submit(func, self.harnesses[port])
+
+    def gather(self, futures: dict, timeout=None) -> dict:
+        '''
+        wait for {port: Future} and return {port: PoolResult}
+        '''
+        wait(futures.values(), timeout)
+        results = {}
+        for port, future in futures.items():
+            if not future.done():
+                results[port] = PoolResult(port, error=TimeoutError(f"{port} not done in {timeout}s"))
+            elif future.exception() is not None:
+                results[port] = PoolResult(port, error=future.exception())
+            else:
+                results[port] = PoolResult(port, value=future.result())
+        return results
+
+    def map(self, func, timeout=None) -> dict:
+        '''
+        fan-out: call func(harness) on every device at once, returns {port: PoolResult}
+        '''
+        return self.gather({port: self.submit(port, func) for port in self.harnesses}, timeout)
+
+    def run(self, transaction_factory, timeout=None) -> dict:
+        '''
+        fan-out: run new transaction on every device, i.e. pool.run(GetDeviceInfo)
+        or with arguments: pool.run(lambda: SetLog("ServiceDesktop", PureLogLevel.LOGINFO))
+        returns {port: PoolResult} with transaction responses
+        '''
+        return self.map(lambda harness: transaction_factory().run(harness), timeout)
+
+    def scatter(self, transactions: dict, timeout=None) -> dict:
+        '''
+        scatter-gather: run {port: transaction} each on its device, returns {port: PoolResult}
+        '''
+        return self.gather({port: self.submit(port, transaction.run)
+                            for port, transaction in transactions.items()}, timeout)
@@ -0,0 +1,168 @@
+# Copyright (c) 2017-2021, Mudita Sp. z.o.o. All rights reserved.
+# For licensing, see https://github.com/mudita/MuditaOS/LICENSE.md
+import asyncio
+import logging
+import os
+import time
+
+from .CDCSerial import CDCSerial, Stats
+from .framing import build_message, decode, header_start, parse_header
+from .deadline import Timeout
+from .timing import Timings
+from .error import ComError, ComTimeout
+
+log = logging.getLogger(__name__)
+
+
+class AsyncCDCSerial:
+    '''
+    asyncio transport for service-desktop, works on already opened CDCSerial port
+    reads and writes are non-blocking and driven by event loop on serial port file descriptor
+    requests on one transport are serialized, requests on different transports (phones) run concurrently
+    WARN: port is read directly, so while async request is pending do not use synchronous CDCSerial.write
+    on the same port, nor enable pipelining, whose reader thread would take responses of this transport;
+    Harness.request_async goes through pipeline when it's enabled instead of using this transport
+    '''
+    read_size = 4096
+
+    def __init__(self, connection: CDCSerial):
+        self.connection = connection
+        self.header_length = connection.header_length
+        self.buffer = bytearray()
+        self.lock = None
+        self.resync = False
+        self.phase = None
+        self.time_to_send = None
+        self.time_to_read = None
+
+    def get_fd(self):
+        return self.connection.get_serial().fileno()
+
+    async def __wait_fd(self, add, remove):
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+
+        def on_ready():
+            if not ready.done():
+                ready.set_result(None)
+
+        add(self.get_fd(), on_ready)
+        try:
+            await ready
+        finally:
+            remove(self.get_fd())
+
+    async def __wait_readable(self):
+        loop = asyncio.get_running_loop()
+        await self.__wait_fd(loop.add_reader, loop.remove_reader)
+
+    async def __wait_writable(self):
+        loop = asyncio.get_running_loop()
+        await self.__wait_fd(loop.add_writer, loop.remove_writer)
+
+    async def __fill(self, length):
+        '''
+        read till there is at least `length` bytes in buffer
+        '''
+        while len(self.buffer) < length:
+            await self.__wait_readable()
+            try:
+                data = os.read(self.get_fd(), max(self.read_size, length - len(self.buffer)))
+            except BlockingIOError:
+                continue
+            if not data:
+                raise ComError(f"Port closed, read {len(self.buffer)} of requested {length}!")
+            self.buffer += data
+
+    async def readRaw(self, length) -> bytes:
+        await self.__fill(length)
+        data = bytes(self.buffer[:length])
+        del self.buffer[:length]
+        return data
+
+    async def read(self, timings: Timings = None):
+        start = time.perf_counter()
+        self.phase = "header"
+        if self.resync:
+            await self.__skip_to_header()
+        header = await self.readRaw(self.header_length)
+        if timings is not None:
+            timings.mark("first_byte")
+        payload_length = parse_header(header)
+        self.phase = "payload"
+        result = await self.readRaw(payload_length)
+        if timings is not None:
+            timings.mark("payload_read")
+        return [result, Stats(start, time.perf_counter())]
+
+    async def __skip_to_header(self):
+        skipped = 0
+        while True:
+            await self.__fill(self.header_length)
+            start = header_start(self.buffer)
+            if start == 0:
+                break
+            skipped += start
+            del self.buffer[:start]
+        if skipped:
+            log.warning(f"skipped {skipped} bytes of interrupted frame")
+        self.resync = False
+
+    def __discard(self):
+        # rest of interrupted frame would break next request, see: FrameReader.discard
+        self.buffer.clear()
+        self.connection.get_serial().reset_input_buffer()
+        self.resync = True
+
+    async def writeRaw(self, message: str):
+        start = time.perf_counter()
+        self.connection.watch_port_status()
+        to_write = memoryview(message.encode() if isinstance(message, str) else message)
+        while to_write:
+            try:
+                written = os.write(self.get_fd(), to_write)
+            except BlockingIOError:
+                written = 0
+            to_write = to_write[written:]
+            if to_write:
+                await self.__wait_writable()
+        return Stats(start, time.perf_counter())
+
+    def get_timing(self):
+        return [self.time_to_send, self.time_to_read]
+
+    async def write(self, msg, timeout=60, timings: Timings = None):
+        '''
+        async equivalent of CDCSerial.write - sends msg and awaits its response
+        timeout covers writing and reading response, ComTimeout with phase which stalled is raised when it passes
+        None - no deadline
+        '''
+        if timings is None:
+            timings = Timings()
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            with Timeout.limit(timeout, request=True) as deadline:
+                try:
+                    return await asyncio.wait_for(self.__request(msg, timings),
+                                                  None if deadline is None else deadline.left())
+                except asyncio.TimeoutError:
+                    self.__discard()
+                    raise ComTimeout.expired(self.phase, deadline)
+                except ComError:
+                    self.__discard()
+                    raise
+
+    async def __request(self, msg, timings: Timings):
+        self.phase = "write"
+        message = build_message(msg)
+        timings.mark("serialized")
+        self.time_to_send = await self.writeRaw(message)
+        timings.mark("written")
+        while True:
+            result, self.time_to_read = await self.read(timings)
+            resp = decode(result)
+            if "uuid" not in msg or resp.get("uuid") == msg["uuid"]:
+                timings.mark("parsed")
+                return resp
+            log.warning(f"discarding response uuid: {resp.get('uuid')}, expected: {msg['uuid']}")
@@ -1,17 +1,25 @@
 # Copyright (c) 2017-2020, Mudita Sp. z.o.o. All rights reserved.
 # For licensing, see https://github.com/mudita/MuditaOS/LICENSE.md
+import os
+import select
+import threading
 import time
 import serial
-import json
 import logging
+from concurrent.futures import Future, TimeoutError
 from enum import Enum
-from random import randrange
 
+from .deadline import Deadline, Timeout
 from .defs import endpoint, method
-from .error import TestError, Error, ComError
+from .error import TestError, Error, ComError, ComTimeout
+from .framing import FrameReader, build_message, decode, header_length
+from .pacing import KeyPacing
+from .pipeline import Pipeline
+from .port_watcher import PortWatcher
+from .timing import Timings
+from .uuid_allocator import UuidAllocator
 from dataclasses import dataclass
 from inotify import adapters
-from inotify.constants import IN_ATTRIB
 
 inotify_logger = logging.getLogger(adapters.__name__)
 inotify_logger.setLevel(logging.ERROR)
@@ -34,9 +42,9 @@ class Stats():
 
 def timed(foo):
     def wrap(*args, **kwargs):
-        start = time.time()
+        start = time.perf_counter()
         ret = foo(*args, **kwargs)
-        end = time.time()
+        end = time.perf_counter()
         return [ret, Stats(start, end)]
     return wrap
 
@@ -45,18 +53,24 @@ class CDCSerial:
     def __init__(self, port_name, timeout=10):
         self.timeout = timeout
         self.body = ""
-        self.header_length = 10
+        self.header_length = header_length
+        self.pipeline = None
+        self.pipeline_users = 0
+        self.pipeline_lock = threading.Lock()
+        self.uuid = UuidAllocator()
+        self.key_pacing = KeyPacing()
         self.port_name = port_name
         while timeout != 0:
             try:
-                self.serial = serial.Serial(port_name, baudrate=115200, timeout=10)
+                self.serial = serial.Serial(port_name, baudrate=115200, timeout=10, write_timeout=10)
                 self.serial.flushInput()
+                self.reader = FrameReader(self.serial)
                 log.info(f"opened port {port_name}!")
                 self.watch_port()
                 break
             except (FileNotFoundError, serial.serialutil.SerialException) as err:
                 log.error(f"can't open {port_name}, retrying...")
-                time.sleep(1)
+                Deadline.sleep(1)
                 self.timeout = self.timeout - 1
                 if self.timeout == 0:
                     log.error(f"uart {port_name} not found - probably OS did not boot")
@@ -64,28 +78,38 @@ class CDCSerial:
 
     def watch_port(self):
         '''
-        inotify in python uses epoll to check notifications
-        set insignificant timeout of 0.01ms instead of 1s default
+        port is watched by background thread, so write path only checks its reboot flag
+        sync read in progress on phone reset is failed right away, its response will never come
         '''
-        self.watch = adapters.Inotify(block_duration_s=0.0)
-        self.watch.add_watch(self.port_name, IN_ATTRIB)
+        self.watcher = PortWatcher(self.port_name)
+        watcher, reader = self.watcher, self.reader
+
+        def on_port_state(state):
+            # reset is reported by failed read, so not again by next request
+            if reader.cancel(TestError(Error.PURE_REBOOT)):
+                watcher.consume_reboot()
+        # callback can't hold self, it would keep connection alive with watcher thread
+        self.watcher.subscribe(on_port_state)
 
     def watch_port_status(self):
-        for event in self.watch.event_gen():
-            if event is None:
-                return
-            (_, type_names, path, filename) = event
-            log.debug(f"inotify {path}/{filename} event: {type_names}")
+        if self.watcher.consume_reboot():
             raise TestError(Error.PURE_REBOOT)
 
     def watch_port_reboot(self, timeout=10):
-        for event in self.watch.event_gen(timeout_s=timeout, yield_nones=False):
-            (_, type_names, path, filename) = event
-            log.debug(f"inotify {path}/{filename} event: {type_names}")
-            return True
-        return False
+        return self.watcher.wait_for_reboot(timeout)
+
+    def subscribe_port_state(self, callback):
+        '''
+        callback(PortState) is called from watcher thread on each port state change
+        '''
+        self.watcher.subscribe(callback)
+
+    def unsubscribe_port_state(self, callback):
+        self.watcher.unsubscribe(callback)
 
     def __del__(self):
+        if hasattr(self, "watcher"):
+            self.watcher.stop()
         try:
             self.serial.close()
             log.info(f"closed port {self.serial.name}")
@@ -96,7 +120,7 @@ class CDCSerial:
         msg = {
             "endpoint": endpoint["developerMode"],
             "method": method["put"],
-            "uuid": randrange(1, 100),
+            "uuid": self.next_uuid(),
             "body": body
         }
         return msg
@@ -104,54 +128,198 @@ class CDCSerial:
     def get_serial(self):
         return self.serial
 
+    def next_uuid(self) -> int:
+        return self.uuid.next()
+
     def __build_message(self, json_data):
-        json_dump = json.dumps(json_data)
-        return "#%09d%s" % (len(json_dump), json_dump)
+        return build_message(json_data)
 
     @timed
-    def read(self, length):
-        header = self.readRaw(length)
-        payload_length = int(header[1:])
-        result = self.readRaw(payload_length)
-        return result
+    def read(self):
+        '''
+        read single frame, returns payload bytes valid till next read
+        '''
+        return self.reader.read_frame()
 
-    def readRaw(self, length):
-        data = self.serial.read(length).decode()
-        data_len = len(data)
-        if data_len == 0 and length != 0:
-            raise ComError(f"Nothing read of requested {length}!")
-        if data_len != length:
-            raise ComError("Not enough data: {data_len} != {length} !")
-        return data
+    def readRaw(self, length, timeout=10):
+        data = bytearray(length)
+        with Timeout.limit(timeout, request=True):
+            self.reader.read_exactly(memoryview(data))
+        return data.decode()
 
     def get_timing(self):
         return [self.time_to_send, self.time_to_read]
 
-    def write(self, msg, timeout=30):
-        message = self.__build_message(msg)
-        ignore, self.time_to_send = self.writeRaw(message)
-        result, self.time_to_read = self.read(self.header_length)
-        return json.loads(result)
+    def write(self, msg, timeout=60, timings: Timings = None):
+        '''
+        send msg and return its response, timings - if provided, filled with request phases timestamps
+        timeout - deadline of whole request: writing, waiting for header and reading payload
+                  ComTimeout with phase which stalled is raised when it passes
+                  None - no deadline, only port timeouts apply
+        '''
+        if timings is None:
+            timings = Timings()
+        with Timeout.limit(timeout, request=True):
+            if self.pipeline is not None:
+                return self.__write_pipelined(msg, timings)
+            message = self.__build_message(msg)
+            timings.mark("serialized")
+            ignore, self.time_to_send = self.writeRaw(message)
+            timings.mark("written")
+            while True:
+                try:
+                    result, self.time_to_read = self.read()
+                except (ComError, TestError, Timeout):
+                    # rest of the frame would break next request
+                    self.reader.discard()
+                    raise
+                resp = decode(result)
+                if "uuid" not in msg or resp.get("uuid") == msg["uuid"]:
+                    timings.mark("first_byte", self.reader.header_time)
+                    timings.mark("payload_read", self.reader.payload_time)
+                    timings.mark("parsed")
+                    return resp
+                # i.e. late response to request which timed out before
+                log.warning(f"discarding response uuid: {resp.get('uuid')}, expected: {msg['uuid']}")
+
+    def __write_pipelined(self, msg, timings: Timings):
+        # active deadline of write applies
+        future = self.pipeline.submit(msg, timings, None)
+        try:
+            result = future.result(Deadline.remaining())
+        except TimeoutError:
+            self.pipeline.abandon(msg["uuid"])
+            raise ComTimeout.expired("response", Deadline.current())
+        self.time_to_send = Stats(timings.start / 1e9, timings.written / 1e9)
+        self.time_to_read = Stats(timings.written / 1e9, timings.parsed / 1e9)
+        return result
+
+    def enable_pipelining(self):
+        '''
+        switch to pipelined mode, where responses are read by background thread
+        and many requests can be in flight at once, see: submit
+        calls are counted - pipelined mode lasts till each of them is matched with disable_pipelining,
+        so one user can't switch it off under another
+        '''
+        with self.pipeline_lock:
+            self.pipeline_users += 1
+            if self.pipeline is None:
+                self.pipeline = Pipeline(self)
+
+    def disable_pipelining(self):
+        with self.pipeline_lock:
+            self.pipeline_users = max(0, self.pipeline_users - 1)
+            if self.pipeline_users == 0 and self.pipeline is not None:
+                self.pipeline.stop()
+                self.pipeline = None
+
+    def is_pipelined(self) -> bool:
+        return self.pipeline is not None
+
+    def submit(self, msg, timings: Timings = None, timeout=60) -> Future:
+        '''
+        send msg without waiting for response, returns future resolved with response
+        without pipelined mode request is executed right away and future is already done
+        timeout - deadline of the request, future fails with ComTimeout when it passes, None - no deadline
+        '''
+        if timings is None:
+            timings = Timings()
+        if self.pipeline is not None:
+            return self.pipeline.submit(msg, timings, timeout)
+        future = Future()
+        try:
+            future.set_result(self.write(msg, timeout, timings))
+        except Exception as e:
+            future.set_exception(e)
+        return future
 
     @timed
-    def writeRaw(self, message, timeout=60):
+    def writeRaw(self, message):
+        '''
+        write whole message, with active deadline writing waits no longer than time left
+        '''
         self.watch_port_status()
-        to_write = message.encode()
+        ComTimeout.check("write")
+        to_write = message.encode() if isinstance(message, str) else message
         to_write_len = len(to_write)
-        len_written = self.serial.write(message.encode())
+        try:
+            len_written = self.__write(to_write)
+        except serial.SerialTimeoutException:
+            deadline = Deadline.current()
+            if deadline is None:
+                raise ComTimeout("write", self.serial.write_timeout)
+            raise ComTimeout.expired("write", deadline)
         if len_written != to_write_len:
             raise ComError(f"Written {len_written} of {to_write_len}")
-        self.serial.timeout = timeout
 
-    def send_key_code(self, key_code, key_type=Keytype.short_press, wait=10):
+    def __write(self, data) -> int:
+        remaining = Deadline.remaining()
+        write_timeout = self.serial.write_timeout
+        if remaining is None or (write_timeout is not None and write_timeout <= remaining):
+            return self.serial.write(data)
+        # polling descriptor instead of shortening write_timeout, its every change is termios call
+        fd = self.serial.fileno()
+        expires = time.monotonic() + remaining
+        view = memoryview(data)
+        while view:
+            try:
+                view = view[os.write(fd, view):]
+            except BlockingIOError:
+                pass
+            except OSError as e:
+                raise serial.SerialException(f"write failed: {e}")
+            if view:
+                left = expires - time.monotonic()
+                if left <= 0 or not select.select([], [fd], [], left)[1]:
+                    raise serial.SerialTimeoutException("Write timeout")
+        return len(data)
+
+    @staticmethod
+    def __key_body(key_code, key_type):
         if key_type is Keytype.long_press:
-            body = {"keyPressed": key_code, "state": 4}
-        else:
-            body = {"keyPressed": key_code, "state": 2}
-        ret = self.write(self.__wrap_message(body), wait)
-        time.sleep(0.3)
+            return {"keyPressed": key_code, "state": 4}
+        return {"keyPressed": key_code, "state": 2}
+
+    def send_key_code(self, key_code, key_type=Keytype.short_press, wait=10):
+        sent = time.perf_counter()
+        ret = self.write(self.__wrap_message(self.__key_body(key_code, key_type)), wait)
+        self.key_pacing.after_key(self, sent)
+        return ret
+
+    def send_key_sequence(self, keys, spacing_s=0, wait=10) -> list:
+        '''
+        send whole key sequence as one pipelined burst and return responses in order
+            keys - list of (key_code, Keytype)
+            spacing_s - optional wait between consecutive key presses
+        key pacing is applied once, after the last key
+        '''
+        self.enable_pipelining()
+        try:
+            sent = time.perf_counter()
+            pending = []
+            for n, (key_code, key_type) in enumerate(keys):
+                if spacing_s and n > 0:
+                    time.sleep(spacing_s)
+                pending.append(self.submit(self.__wrap_message(self.__key_body(key_code, key_type))))
+            with Timeout.limit(wait, request=True) as deadline:
+                try:
+                    ret = [future.result(Deadline.remaining()) for future in pending]
+                except TimeoutError:
+                    raise ComTimeout.expired("response", deadline)
+        finally:
+            self.disable_pipelining()
+        self.key_pacing.after_key(self, sent)
         return ret
 
+    def set_key_pacing(self, pacing: KeyPacing):
+        self.key_pacing = pacing
+
+    def settle(self):
+        '''
+        wait for UI to settle after key press, depends on key pacing
+        '''
+        self.key_pacing.settle(self)
+
     def enable_echo_mode(self):
         echoOnCmd = "UsbCdcEcho=ON"
         self.writeRaw(echoOnCmd)
@@ -174,24 +342,24 @@ class CDCSerial:
             "timeout": timeout
         }
 
-        ret = self.write(self.__wrap_message(body), timeout / 1000 + wait)
+        ret = self.write(self.__wrap_message(body), None if wait is None else timeout / 1000 + wait)
         log.info(f"at response {ret}")
         return ret["body"]["ATResponse"]
 
-    def get_application_name(self):
+    def get_application_name(self, timeout=60):
         body = {
             "focus": True
         }
 
-        ret = self.write(self.__wrap_message(body))
+        ret = self.write(self.__wrap_message(body), timeout)
         return ret["body"]["focus"]
 
-    def is_phone_locked(self):
+    def is_phone_locked(self, timeout=60):
         body = {
             "phoneLocked": True
         }
 
-        ret = self.write(self.__wrap_message(body))
+        ret = self.write(self.__wrap_message(body), timeout)
         return ret["body"]["phoneLocked"]
 
     @staticmethod
@@ -203,3 +371,25 @@ class CDCSerial:
         return [_.device for _ in list_ports.comports() if _.manufacturer == 'Mudita' and
                     (_.product == 'Mudita Pure' or _.product == 'Mudita Harmony')]
 
+    @staticmethod
+    def find_serial_number(port_name: str) -> str:
+        '''
+        Return USB serial number of device on port_name, None if there is no such USB device
+        '''
+        import serial.tools.list_ports as list_ports
+        for port in list_ports.comports():
+            if port.device == port_name:
+                return port.serial_number
+        return None
+
+    @staticmethod
+    def find_port(serial_number: str) -> str:
+        '''
+        Return port of USB device with serial_number, None if it's not connected
+        '''
+        import serial.tools.list_ports as list_ports
+        for port in list_ports.comports():
+            if serial_number is not None and port.serial_number == serial_number:
+                return port.device
+        return None
+
@@ -0,0 +1,75 @@
+# Copyright (c) 2017-2021, Mudita Sp. z.o.o. All rights reserved.
+# For licensing, see https://github.com/mudita/MuditaOS/LICENSE.md
+import json
+import logging
+
+log = logging.getLogger(__name__)
+
+'''
+JSON codec used to encode requests and decode responses
+fastest installed library is used: orjson, ujson or standard json as fallback
+    dumps(obj) -> bytes
+    loads(bytes-like object) -> obj
+'''
+
+
+def _json_dumps(obj) -> bytes:
+    return json.dumps(obj).encode()
+
+
+def _json_loads(data):
+    return json.loads(bytes(data) if isinstance(data, memoryview) else data)
+
+
+def _orjson():
+    import orjson
+
+    def dumps(obj) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+    return dumps, orjson.loads
+
+
+def _ujson():
+    import ujson
+
+    def dumps(obj) -> bytes:
+        return ujson.dumps(obj, ensure_ascii=False).encode()
+
+    def loads(data):
+        return ujson.loads(bytes(data) if isinstance(data, memoryview) else data)
+
+    return dumps, loads
+
+
+def _json():
+    return _json_dumps, _json_loads
+
+
+codecs = {
+    "orjson": _orjson,
+    "ujson": _ujson,
+    "json": _json,
+}
+
+name = None
+dumps = None
+loads = None
+
+
+def use(codec: str):
+    '''
+    select codec by name, raises ImportError if library is not installed
+    '''
+    global name, dumps, loads
+    dumps, loads = codecs[codec]()
+    name = codec
+    log.debug(f"using {codec} codec")
+
+
+for _codec in codecs:
+    try:
+        use(_codec)
+        break
+    except ImportError:
+        pass
@@ -0,0 +1,132 @@
+# Copyright (c) 2017-2021, Mudita Sp. z.o.o. All rights reserved.
+# For licensing, see https://github.com/mudita/MuditaOS/LICENSE.md
+import contextvars
+import signal
+import threading
+import time
+from contextlib import contextmanager
+
+_current = contextvars.ContextVar("harness_deadline", default=None)
+
+
+class Deadline:
+    '''
+    monotonic point in time by which work has to be done, see: Timeout.limit
+    active deadline is kept per thread and per asyncio task, nested limits keep the tightest one
+    deadline is cooperative - waits and serial reads check it instead of being interrupted by signal
+        request - deadline of harness request, its expiry is ComTimeout, expiry of other ones is plain Timeout
+    '''
+    def __init__(self, seconds: float, request=False):
+        self.seconds = seconds
+        self.request = request
+        self.expires = time.monotonic() + seconds
+
+    def left(self) -> float:
+        return max(0.0, self.expires - time.monotonic())
+
+    @staticmethod
+    def current():
+        return _current.get()
+
+    @staticmethod
+    def remaining(default=None):
+        '''
+        seconds left till active deadline, `default` if there is none
+        '''
+        deadline = _current.get()
+        if deadline is None:
+            return default
+        return deadline.left()
+
+    @staticmethod
+    def clamp(timeout):
+        '''
+        limit timeout (None - no timeout) to time left till active deadline
+        '''
+        remaining = Deadline.remaining()
+        if remaining is None:
+            return timeout
+        if timeout is None:
+            return remaining
+        return min(timeout, remaining)
+
+    @staticmethod
+    def check():
+        '''
+        raise Timeout if active deadline passed
+        '''
+        if Deadline.remaining() == 0.0:
+            raise Timeout("Timed out!")
+
+    @staticmethod
+    def sleep(seconds: float):
+        '''
+        time.sleep which wakes up and raises Timeout at active deadline
+        '''
+        Deadline.check()
+        time.sleep(Deadline.clamp(seconds))
+        Deadline.check()
+
+
+@contextmanager
+def _alarm(deadline: Deadline):
+    '''
+    SIGALRM at deadline, interrupting any code of main thread, as Timeout did before deadlines
+    '''
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def on_alarm(signum, frame):
+        raise Timeout("Timed out!")
+
+    previous = signal.signal(signal.SIGALRM, on_alarm)
+    previous_delay, _ = signal.setitimer(signal.ITIMER_REAL, max(deadline.left(), 1e-6))
+    armed = time.monotonic()
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+        if previous_delay:
+            # alarm of outer limit
+            signal.setitimer(signal.ITIMER_REAL, max(previous_delay - (time.monotonic() - armed), 1e-6))
+
+
+class Timeout(Exception):
+    '''
+    usage:
+        try:
+            with Timeout.limit(10):
+                long_function_call()
+        except Timeout as e:
+            print("Timed out!")
+    works in any thread and asyncio task, with millisecond resolution and nesting,
+    long_function_call has to wait with Deadline.sleep, or do serial reads to be stopped
+    limit(None) sets no deadline, outer one stays active
+        request - used by harness for deadlines of its requests, see: Deadline
+        interrupt - raise Timeout with SIGALRM at deadline, to stop code which doesn't check it
+                    i.e. time.sleep loops, works only in main thread
+    '''
+
+    @classmethod
+    @contextmanager
+    def limit(cls, seconds: float, request=False, interrupt=False):
+        if seconds is None:
+            yield _current.get()
+            return
+        if seconds <= 0:
+            raise ValueError("Timeout must be positive !")
+        deadline = Deadline(seconds, request)
+        outer = _current.get()
+        if outer is not None and outer.expires < deadline.expires:
+            deadline = outer
+        token = _current.set(deadline)
+        try:
+            if interrupt:
+                with _alarm(deadline):
+                    yield deadline
+            else:
+                yield deadline
+        finally:
+            _current.reset(token)
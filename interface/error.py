@@ -2,6 +2,8 @@
 # For licensing, see https://github.com/mudita/MuditaOS/LICENSE.md
 from enum import IntEnum
 
+from .deadline import Deadline, Timeout
+
 
 class Error(IntEnum):
     PORT_NOT_FOUND = 1,
@@ -28,3 +30,33 @@ class TestError(Exception):
 
 class ComError(Exception):
     pass
+
+
+class ComTimeout(ComError, Timeout):
+    '''
+    request not done before its deadline, phase tells what stalled:
+    write, header, payload or response (when read by pipeline)
+    '''
+    def __init__(self, phase: str, timeout: float):
+        self.phase = phase
+        self.timeout = timeout
+        super().__init__(f"Timed out in {phase} phase, after {timeout}s")
+
+    @classmethod
+    def expired(cls, phase: str, deadline: Deadline) -> Timeout:
+        '''
+        error for passed deadline: ComTimeout if it's deadline of harness request,
+        plain Timeout if it's outer one, so retry loops catching ComError don't swallow it
+        '''
+        if deadline is None or deadline.request:
+            return cls(phase, None if deadline is None else deadline.seconds)
+        return Timeout(f"Timed out in {phase} phase, outer deadline of {deadline.seconds}s passed")
+
+    @classmethod
+    def check(cls, phase: str):
+        '''
+        raise ComTimeout, or Timeout, see: expired, if active deadline passed
+        '''
+        deadline = Deadline.current()
+        if deadline is not None and deadline.left() == 0.0:
+            raise cls.expired(phase, deadline)
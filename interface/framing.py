@@ -0,0 +1,193 @@
+# Copyright (c) 2017-2021, Mudita Sp. z.o.o. All rights reserved.
+# For licensing, see https://github.com/mudita/MuditaOS/LICENSE.md
+import logging
+import os
+import select
+import time
+
+from . import codec
+from .deadline import Deadline
+from .error import ComError, ComTimeout
+
+log = logging.getLogger(__name__)
+
+'''
+service-desktop frame: `#` + payload length in bytes on 9 digits + utf-8 json payload
+'''
+header_length = 10
+
+
+def build_message(json_data) -> bytes:
+    json_dump = codec.dumps(json_data)
+    return b"#%09d%s" % (len(json_dump), json_dump)
+
+
+def parse_header(header) -> int:
+    '''
+    returns payload length in bytes
+    '''
+    if len(header) != header_length or header[0] != ord('#') or not bytes(header[1:]).isdigit():
+        raise ComError(f"Malformed frame header: {bytes(header)}")
+    return int(header[1:])
+
+
+def header_start(data) -> int:
+    '''
+    offset of first `#` in data which can start frame header - followed by digits as far as data goes,
+    len(data) if there is none
+    '''
+    start = data.find(b"#")
+    while start >= 0:
+        digits = bytes(data[start + 1:start + header_length])
+        if not digits or digits.isdigit():
+            return start
+        start = data.find(b"#", start + 1)
+    return len(data)
+
+
+def decode(payload):
+    '''
+    decode frame payload, payload can be any bytes-like object
+    '''
+    return codec.loads(payload)
+
+
+class FrameReader:
+    '''
+    reads frames from serial port into reusable buffer, without decoding payload to str
+    returned payload is memoryview on internal buffer - valid till next read_frame call
+    header_time and payload_time are perf_counter_ns timestamps of last frame header and payload arrival
+        keep_waiting - if provided, called when read timed out with no data,
+                       reading continues if it returns True instead of raising ComError
+    with active deadline, see: Timeout.limit, reading continues till the deadline
+    and waits no longer than time left, ComTimeout is raised when it passes
+    after discard, i.e. on timeout in the middle of frame, data till next frame header is skipped
+    read waiting for data can be failed from other thread with cancel, i.e. on phone reset
+    '''
+    initial_size = 4096
+
+    def __init__(self, port, keep_waiting=None):
+        self.port = port
+        self.keep_waiting = keep_waiting
+        self.header = bytearray(header_length)
+        self.buffer = bytearray(self.initial_size)
+        self.header_time = 0
+        self.payload_time = 0
+        self.resync = False
+        self.waiting = False
+        self.cancelled = None
+        # wakes up select in readinto, port.cancel_read does it for port reads
+        self.wake_r, self.wake_w = os.pipe()
+        os.set_blocking(self.wake_r, False)
+        os.set_blocking(self.wake_w, False)
+
+    def __del__(self):
+        for fd in (getattr(self, "wake_r", None), getattr(self, "wake_w", None)):
+            if fd is not None:
+                os.close(fd)
+
+    def cancel(self, error: Exception) -> bool:
+        '''
+        make read in progress raise error, returns False if no read waits for data
+        '''
+        if not self.waiting:
+            return False
+        self.cancelled = error
+        if hasattr(self.port, "cancel_read"):
+            self.port.cancel_read()
+        try:
+            os.write(self.wake_w, b"\0")
+        except BlockingIOError:
+            pass
+        return True
+
+    def discard(self):
+        '''
+        drop rest of interrupted frame: input buffer is cleared and next read skips data till frame header
+        '''
+        self.port.reset_input_buffer()
+        self.resync = True
+
+    def readinto(self, view: memoryview) -> int:
+        remaining = Deadline.remaining()
+        timeout = self.port.timeout
+        if remaining is None or (timeout is not None and timeout <= remaining):
+            return self.port.readinto(view)
+        # waiting on descriptor instead of shortening port timeout, its every change is termios call
+        fd = self.port.fileno()
+        ready = select.select([fd, self.wake_r], [], [], remaining)[0]
+        if self.wake_r in ready:
+            os.read(self.wake_r, 64)
+            return 0
+        if not ready:
+            return 0
+        try:
+            read = os.readv(fd, [view])
+        except BlockingIOError:
+            return 0
+        if not read:
+            raise ComError("Port ready to read but returned no data, device disconnected?")
+        return read
+
+    def read_exactly(self, view: memoryview, phase="payload"):
+        # cancel which came after previous read ended
+        self.cancelled = None
+        self.waiting = True
+        try:
+            self.__read_exactly(view, phase)
+        finally:
+            self.waiting = False
+
+    def __read_exactly(self, view: memoryview, phase):
+        length = len(view)
+        done = 0
+        while done < length:
+            try:
+                read = self.readinto(view[done:])
+            except Exception:
+                # i.e. port gone on phone reset, cancel error tells more
+                if self.cancelled is None:
+                    raise
+                read = 0
+            if self.cancelled is not None:
+                error, self.cancelled = self.cancelled, None
+                raise error
+            if not read:
+                if Deadline.current() is not None:
+                    ComTimeout.check(phase)
+                    continue
+                if self.keep_waiting is not None and self.keep_waiting():
+                    continue
+                if done == 0:
+                    raise ComError(f"Nothing read of requested {length}!")
+                raise ComError(f"Not enough data: {done} != {length} !")
+            done += read
+
+    def read_header(self):
+        view = memoryview(self.header)
+        self.read_exactly(view, "header")
+        if not self.resync:
+            return
+        skipped = 0
+        start = header_start(self.header)
+        while start:
+            # whole header is read, so start == 0 means it's valid
+            skipped += start
+            kept = header_length - start
+            self.header[:kept] = self.header[start:]
+            self.read_exactly(view[kept:], "header")
+            start = header_start(self.header)
+        if skipped:
+            log.warning(f"skipped {skipped} bytes of interrupted frame")
+        self.resync = False
+
+    def read_frame(self) -> memoryview:
+        self.read_header()
+        self.header_time = time.perf_counter_ns()
+        length = parse_header(self.header)
+        if len(self.buffer) < length:
+            self.buffer = bytearray(max(length, 2 * len(self.buffer)))
+        payload = memoryview(self.buffer)[:length]
+        self.read_exactly(payload, "payload")
+        self.payload_time = time.perf_counter_ns()
+        return payload
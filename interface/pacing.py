@@ -0,0 +1,49 @@
+# Copyright (c) 2017-2021, Mudita Sp. z.o.o. All rights reserved.
+# For licensing, see https://github.com/mudita/MuditaOS/LICENSE.md
+import time
+
+
+class KeyPacing:
+    '''
+    fixed key press pacing, the default:
+        interval_s - wait after each key press
+        settle_s - additional wait after navigation keys sent by utils, i.e. send_keystoke
+    '''
+    def __init__(self, interval_s=0.3, settle_s=0.3):
+        self.interval_s = interval_s
+        self.settle_s = settle_s
+
+    def after_key(self, connection, sent: float):
+        '''
+        called after key press response, sent - time.perf_counter() when key was sent
+        '''
+        time.sleep(self.interval_s)
+
+    def settle(self, connection):
+        time.sleep(self.settle_s)
+
+
+class AdaptiveKeyPacing(KeyPacing):
+    '''
+    key press pacing driven by device readiness instead of fixed sleeps:
+        - key press response means service-desktop accepted the key
+        - probe - if set, cheap `focus` request is sent, its response means
+          device handled requests queued before it
+        - min_interval_s - minimal time between consecutive key presses
+    use example:
+        harness.set_key_pacing(AdaptiveKeyPacing(min_interval_s=0.05))
+    '''
+    def __init__(self, min_interval_s=0.05, probe=True):
+        super().__init__(interval_s=min_interval_s, settle_s=0)
+        self.min_interval_s = min_interval_s
+        self.probe = probe
+
+    def after_key(self, connection, sent: float):
+        if self.probe:
+            connection.get_application_name()
+        remaining = self.min_interval_s - (time.perf_counter() - sent)
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def settle(self, connection):
+        pass
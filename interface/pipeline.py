@@ -0,0 +1,151 @@
+# Copyright (c) 2017-2021, Mudita Sp. z.o.o. All rights reserved.
+# For licensing, see https://github.com/mudita/MuditaOS/LICENSE.md
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+import serial
+
+from .deadline import Timeout
+from .error import ComError, ComTimeout, Error, TestError
+from .framing import FrameReader, build_message, decode
+from .timing import Timings
+
+log = logging.getLogger(__name__)
+
+
+class Pipeline:
+    '''
+    pipelined request mode of CDCSerial:
+        - requests are written right away, without waiting for previous responses
+        - background reader thread parses incoming `#%09d` frames
+        - each frame resolves future of pending request with the same uuid
+    frames with uuid of no pending request (i.e. late responses of abandoned requests) are discarded
+    each request has deadline, reader fails its future with ComTimeout("response") when it passes
+    '''
+    # read timeout of reader thread, limits time needed to stop the pipeline
+    poll_time_s = 0.1
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.running = True
+        self.connection.subscribe_port_state(self.__on_port_state)
+        self.reader = threading.Thread(target=self.__read_loop, name=f"pipeline {connection.port_name}",
+                                       daemon=True)
+        self.reader.start()
+
+    def submit(self, msg: dict, timings: Timings, timeout=60) -> Future:
+        '''
+        send msg and return future resolved with its response, timings are filled in on the way
+        msg without uuid, or with uuid already in flight, gets new one from connection allocator
+        timeout - seconds to wait for response, limited by active deadline, None - wait till stop
+        '''
+        future = Future()
+        with Timeout.limit(timeout, request=True) as deadline:
+            expires = None if deadline is None else deadline.expires
+            error = ComTimeout.expired("response", deadline)
+        with self.lock:
+            if not self.running:
+                raise ComError("Pipeline stopped")
+            if msg.get("uuid", -1) <= 0 or msg["uuid"] in self.pending:
+                msg["uuid"] = self.connection.next_uuid()
+            self.pending[msg["uuid"]] = (future, timings, expires, error)
+            try:
+                message = build_message(msg)
+                timings.mark("serialized")
+                self.connection.writeRaw(message)
+                timings.mark("written")
+            except Exception:
+                del self.pending[msg["uuid"]]
+                raise
+        return future
+
+    def abandon(self, uuid: int):
+        '''
+        stop waiting for response, i.e. on timeout - response will be discarded if it comes later
+        '''
+        with self.lock:
+            self.pending.pop(uuid, None)
+
+    def in_flight(self) -> int:
+        return len(self.pending)
+
+    def stop(self):
+        self.running = False
+        self.connection.unsubscribe_port_state(self.__on_port_state)
+        if self.reader is not threading.current_thread():
+            # wake reader up instead of waiting for its poll timeout
+            port = self.connection.get_serial()
+            if hasattr(port, "cancel_read"):
+                port.cancel_read()
+            self.reader.join()
+        self.__fail_pending(ComError("Pipeline stopped"))
+
+    def __on_port_state(self, state):
+        # phone reset - requests in flight will never get response
+        self.__fail_pending(TestError(Error.PURE_REBOOT))
+
+    def __fail_pending(self, error: Exception):
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+        for future, *_ in pending.values():
+            future.set_exception(error)
+
+    def __expire_pending(self):
+        now = time.monotonic()
+        with self.lock:
+            expired = [uuid for uuid, (_, _, expires, _) in self.pending.items()
+                       if expires is not None and expires <= now]
+            expired = [self.pending.pop(uuid) for uuid in expired]
+        for future, _, _, error in expired:
+            future.set_exception(error)
+
+    def __keep_waiting(self) -> bool:
+        # called by reader on each poll timeout with no data
+        self.__expire_pending()
+        return self.running
+
+    def __resolve(self, resp: dict, reader: FrameReader):
+        with self.lock:
+            future, timings, _, _ = self.pending.pop(resp.get("uuid"), (None, None, None, None))
+        if future is None:
+            log.warning(f"discarding frame of no pending request, uuid: {resp.get('uuid')}")
+            return
+        timings.mark("first_byte", reader.header_time)
+        timings.mark("payload_read", reader.payload_time)
+        timings.mark("parsed")
+        future.set_result(resp)
+
+    def __read_loop(self):
+        port = self.connection.get_serial()
+        port_timeout = port.timeout
+        port.timeout = self.poll_time_s
+        reader = FrameReader(port, keep_waiting=self.__keep_waiting)
+        try:
+            self.__read_frames(port, reader)
+        finally:
+            port.timeout = port_timeout
+
+    def __read_frames(self, port, reader: FrameReader):
+        while self.running:
+            try:
+                resp = decode(reader.read_frame())
+            except (serial.serialutil.SerialException, OSError) as e:
+                log.error(f"pipeline reader stopped: {e}")
+                self.running = False
+                self.__fail_pending(ComError(f"Port error: {e}"))
+                break
+            except (ComError, ValueError) as e:
+                if not self.running:
+                    break
+                # broken frame, we don't know which request it belonged to
+                log.error(f"broken frame: {e}")
+                port.reset_input_buffer()
+                self.__fail_pending(ComError(f"Broken frame: {e}"))
+                continue
+            self.__resolve(resp, reader)
+            self.__expire_pending()
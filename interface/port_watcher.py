@@ -0,0 +1,142 @@
+# Copyright (c) 2017-2021, Mudita Sp. z.o.o. All rights reserved.
+# For licensing, see https://github.com/mudita/MuditaOS/LICENSE.md
+import atexit
+import logging
+import os
+import threading
+import weakref
+from enum import Enum
+
+from inotify import adapters
+from inotify.calls import InotifyError
+from inotify.constants import IN_ATTRIB, IN_CREATE, IN_DELETE, IN_DELETE_SELF
+
+log = logging.getLogger(__name__)
+
+_watchers = weakref.WeakSet()
+
+
+@atexit.register
+def _stop_watchers():
+    '''
+    daemon thread killed at interpreter exit while logging would leave logging lock taken
+    and hang logging from __del__ methods, so watchers are stopped before that
+    '''
+    for watcher in list(_watchers):
+        watcher.stop(wait=True)
+
+
+class PortState(Enum):
+    CONNECTED = 0
+    CHANGED = 1
+    DISCONNECTED = 2
+    RECONNECTED = 3
+
+
+class PortWatcher:
+    '''
+    background watcher of serial port file, keeps connection state up to date without touching write path:
+        - CHANGED - port attributes changed, what happens when phone resets
+        - DISCONNECTED - port file removed
+        - RECONNECTED - port file created again
+    any state change sets reboot flag, see: rebooted, consume_reboot, wait_for_reboot
+    callbacks registered with subscribe are called from watcher thread with new PortState
+    '''
+    # inotify poll time, limits time needed to stop the watcher
+    poll_time_s = 0.5
+
+    def __init__(self, port_name: str):
+        self.port_name = port_name
+        self.directory, self.filename = os.path.split(port_name)
+        self.state = PortState.CONNECTED
+        self.reboot = threading.Event()
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.running = True
+        self.watch = adapters.Inotify(block_duration_s=self.poll_time_s)
+        self.watch.add_watch(self.port_name, IN_ATTRIB | IN_DELETE_SELF)
+        self.watch.add_watch(self.directory, IN_CREATE | IN_DELETE)
+        self.thread = threading.Thread(target=self.__watch_loop, name=f"watcher {port_name}", daemon=True)
+        self.thread.start()
+        _watchers.add(self)
+
+    def stop(self, wait=False):
+        self.running = False
+        if wait and self.thread is not threading.current_thread():
+            self.thread.join(2 * self.poll_time_s)
+
+    def subscribe(self, callback):
+        with self.lock:
+            self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            if callback in self.subscribers:
+                self.subscribers.remove(callback)
+
+    def rebooted(self) -> bool:
+        return self.reboot.is_set()
+
+    def consume_reboot(self) -> bool:
+        '''
+        returns True once per reboot, i.e. to raise error only on first request after it
+        '''
+        with self.lock:
+            rebooted = self.reboot.is_set()
+            self.reboot.clear()
+        return rebooted
+
+    def wait_for_reboot(self, timeout) -> bool:
+        rebooted = self.reboot.wait(timeout)
+        self.consume_reboot()
+        return rebooted
+
+    def __set_state(self, state: PortState):
+        log.debug(f"port {self.port_name} state: {state.name}")
+        with self.lock:
+            self.state = state
+            self.reboot.set()
+            subscribers = list(self.subscribers)
+        for callback in subscribers:
+            try:
+                callback(state)
+            except Exception as e:
+                log.error(f"port state callback failed: {e!r}")
+
+    def __forget_port_watch(self):
+        '''
+        kernel already dropped watch of removed port file, both path and wd tracking has to be cleared
+        or add_watch on reconnect is skipped as "already being watched"
+        '''
+        try:
+            self.watch.remove_watch(self.port_name, superficial=True)
+        except InotifyError:
+            # inotify 0.2.10 ignores superficial and calls rm_watch on stale wd, after clearing tracking
+            pass
+
+    def __handle(self, event):
+        (header, type_names, path, filename) = event
+        log.debug(f"inotify {path}/{filename} event: {type_names}")
+        if path == self.port_name:
+            if "IN_ATTRIB" in type_names:
+                self.__set_state(PortState.CHANGED)
+            if "IN_IGNORED" in type_names:
+                self.__forget_port_watch()
+        elif filename == self.filename:
+            if "IN_DELETE" in type_names:
+                self.__set_state(PortState.DISCONNECTED)
+            if "IN_CREATE" in type_names:
+                self.watch.add_watch(self.port_name, IN_ATTRIB | IN_DELETE_SELF)
+                self.__set_state(PortState.RECONNECTED)
+
+    def __watch_loop(self):
+        while self.running:
+            try:
+                for event in self.watch.event_gen(yield_nones=True):
+                    if not self.running:
+                        break
+                    if event is not None:
+                        self.__handle(event)
+            except Exception as e:
+                log.error(f"port watcher stopped: {e!r}")
+                self.running = False
@@ -0,0 +1,63 @@
+# Copyright (c) 2017-2021, Mudita Sp. z.o.o. All rights reserved.
+# For licensing, see https://github.com/mudita/MuditaOS/LICENSE.md
+import time
+from dataclasses import dataclass, field
+
+
+@dataclass
+class Timings:
+    '''
+    monotonic time.perf_counter_ns() timestamps of single request phases:
+        start        - request created
+        serialized   - request encoded to frame
+        written      - frame written to port
+        first_byte   - response frame header received
+        payload_read - response payload received
+        parsed       - response payload decoded from JSON
+        validated    - response checked, filled in by Transaction
+    phases not reached are 0
+    '''
+    start: int = field(default_factory=time.perf_counter_ns)
+    serialized: int = 0
+    written: int = 0
+    first_byte: int = 0
+    payload_read: int = 0
+    parsed: int = 0
+    validated: int = 0
+
+    phases = ("serialized", "written", "first_byte", "payload_read", "parsed", "validated")
+
+    def mark(self, phase: str, timestamp: int = None):
+        setattr(self, phase, time.perf_counter_ns() if timestamp is None else timestamp)
+
+    def durations(self) -> dict:
+        '''
+        returns duration of each reached phase in ns, measured from end of previous phase
+            serialized   - time spent in Python encoding request
+            written      - time spent writing to USB
+            first_byte   - time phone spent processing request
+            payload_read - time spent reading response from USB
+            parsed       - time spent in Python decoding response
+            validated    - time spent in Python validating response
+        '''
+        ret = {}
+        previous = self.start
+        for phase in self.phases:
+            timestamp = getattr(self, phase)
+            if timestamp == 0:
+                break
+            ret[phase] = timestamp - previous
+            previous = timestamp
+        return ret
+
+    def total(self) -> int:
+        '''
+        ns from start till last reached phase
+        '''
+        return sum(self.durations().values())
+
+    def send_time(self) -> float:
+        return (self.written - self.start) / 1e9 if self.written else 0.0
+
+    def read_time(self) -> float:
+        return (self.parsed - self.written) / 1e9 if self.parsed else 0.0
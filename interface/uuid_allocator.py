@@ -0,0 +1,20 @@
+# Copyright (c) 2017-2021, Mudita Sp. z.o.o. All rights reserved.
+# For licensing, see https://github.com/mudita/MuditaOS/LICENSE.md
+import threading
+
+
+class UuidAllocator:
+    '''
+    per-connection monotonic request uuid generator, thread safe
+    uuid is reused only after wrapping around max_uuid, so responses can be matched to requests
+    '''
+    max_uuid = 2 ** 31 - 1
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last = 0
+
+    def next(self) -> int:
+        with self.lock:
+            self.last = self.last % self.max_uuid + 1
+            return self.last
@@ -1,4 +1,5 @@
 from .interface.defs import Method, Status, Endpoint
+from .interface.timing import Timings
 from dataclasses import dataclass, field
 from dataclasses_json import dataclass_json
 
@@ -15,10 +16,12 @@ class TransactionError(Exception):
     '''
     General error during tranmission due to wrong Status
     should be risen if respose is of any other than OK or Accepted
+    response - if available, i.e. to get id of existing record on Conflict
     '''
-    def __init__(self, status: Status, message="HTTP Transaction Error!"):
+    def __init__(self, status: Status, message="HTTP Transaction Error!", response=None):
         self.status = status
         self.message = message
+        self.response = response
 
 
 @dataclass_json
@@ -39,7 +42,7 @@ class Response:
         if something was not done properly, or there was HTTP error
         '''
         if ((self.status >= Status.BadRequest.value)):
-            raise TransactionError(self.status)
+            raise TransactionError(self.status, response=self)
 
 
 @dataclass_json
@@ -54,6 +57,12 @@ class Request():
     body: dict = field(default_factory=dict)
     uuid: int = -1
 
+    def to_message(self) -> dict:
+        '''
+        fast equivalent of to_dict() used to send request, body is not copied
+        '''
+        return {"endpoint": self.endpoint, "method": self.method, "body": self.body, "uuid": self.uuid}
+
 
 class Transaction:
     '''
@@ -63,10 +72,14 @@ class Transaction:
     '''
     def __init__(self, request: Request):
         self.request = request
+        self.timings = Timings()
 
     def accept(self, resp: dict) -> None:
         self.response = Response(**resp)
+        if self.request.uuid > 0 and self.response.uuid != self.request.uuid:
+            raise TransmissionError(f"Response uuid {self.response.uuid} to request uuid {self.request.uuid}")
         self.response.validate()
+        self.timings.mark("validated")
 
     def set_elapsed(self, send, read):
         '''
@@ -77,3 +90,9 @@ class Transaction:
         '''
         self.send_time = send
         self.read_time = read
+
+    def get_timings(self) -> Timings:
+        '''
+        per phase timestamps of this exchange, see: Timings.durations()
+        '''
+        return self.timings
@@ -1,8 +1,7 @@
 from .harness import Harness
 from .interface.error import TestError, Error
 from . import log
-from .utils import Timeout
-import time
+from .interface.deadline import Deadline, Timeout
 
 
 simulator_port = 'simulator'
@@ -28,10 +27,10 @@ def get_harness_automatic(timeout, retry_time_s=1) -> Harness:
                 harness = Harness.from_detect()
             except TestError as e:
                 if e.get_error_code() == Error.PORT_NOT_FOUND:
-                    time.sleep(retry_time_s)
+                    Deadline.sleep(retry_time_s)
             if harness is not None:
                 log.debug(f'found port, waiting {detection_to_readiness_time}s for device to be ready')
-                time.sleep(detection_to_readiness_time)
+                Deadline.sleep(detection_to_readiness_time)
     return harness
 
 
@@ -54,7 +53,7 @@ def get_harness_by_port_name(port: str, timeout, retry_time_s=1) -> Harness:
                 try:
                     file = open("/tmp/purephone_pts_name", "r")
                 except FileNotFoundError:
-                    time.sleep(retry_time_s)
+                    Deadline.sleep(retry_time_s)
         port = file.readline()
         if port.isascii():
             log.debug("found {} entry!".format(port))
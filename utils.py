@@ -1,7 +1,8 @@
 # Copyright (c) 2017-2021, Mudita Sp. z.o.o. All rights reserved.
 # For licensing, see https://github.com/mudita/MuditaOS/LICENSE.md
 
-import time
+from dataclasses import dataclass
+from functools import lru_cache
 
 from .interface.CDCSerial import Keytype
 from .interface.defs import key_codes
@@ -201,10 +202,28 @@ emojis_keymap = {
     U'😼': "ssdddddd"
 }
 
+def key_sequence(keys) -> list:
+    '''
+    normalize keys to list of (key_code, Keytype), accepts mix of:
+        - key names, i.e. keypath from application_keypath
+        - key codes, i.e. pin digits
+        - (key_code, Keytype) tuples
+    '''
+    sequence = []
+    for key in keys:
+        if isinstance(key, tuple):
+            sequence.append(key)
+        elif isinstance(key, str):
+            sequence.append((key_codes[key], Keytype.short_press))
+        else:
+            sequence.append((key, Keytype.short_press))
+    return sequence
+
+
 def send_keystoke(keypath, connection):
     for key in keypath:
         connection.send_key_code(key_codes[key])
-        time.sleep(0.3)
+        connection.settle()
 
 
 last_char = '\0'
@@ -261,11 +280,82 @@ def send_char(char: str, connection):
         connection.send_key_code(key_codes["enter"], key_type)
 
 
+@dataclass(frozen=True)
+class KeyPlan:
+    '''
+    compiled key program typing `text`, see: compile_text
+    '''
+    text: str
+    keys: tuple
+
+    @property
+    def key_count(self) -> int:
+        return len(self.keys)
+
+    def estimated_time(self, interval_s: float) -> float:
+        '''
+        estimated typing time when each key costs `interval_s`
+        '''
+        return self.key_count * interval_s
+
+
+@lru_cache(maxsize=256)
+def compile_text(text: str) -> KeyPlan:
+    '''
+    compile text to minimal key program, the same as typing with send_char except:
+        - case is toggled once per run of lowercase letters, not three times per letter
+        - ascii characters missing in keymap are typed with special characters picker
+        - picker characters are committed, so following key never needs `right` to break multi-tap
+    typing starts and ends in uppercase mode, as send_char does
+    raises KeyError on character which can't be typed
+    '''
+    short, long = Keytype.short_press, Keytype.long_press
+    keys = []
+    last_key = '\0'
+    lowercase = False
+
+    def set_lowercase(enable: bool):
+        nonlocal lowercase
+        if lowercase != enable:
+            # uppercase -> lowercase is one press, lowercase -> uppercase two
+            keys.extend([(key_codes["*"], short)] * (1 if enable else 2))
+            lowercase = enable
+
+    for char in text:
+        if char.isascii() and char.isdigit():
+            if last_key == char:
+                keys.append((key_codes["right"], short))
+            keys.append((int(char), long))
+            keys.append((key_codes["right"], short))
+            last_key = char
+        elif char.isascii() and char.upper() in keymap:
+            if char.isalpha():
+                set_lowercase(char.islower())
+            taps = keymap[char.upper()]
+            if last_key == taps[0]:
+                keys.append((key_codes["right"], short))
+            keys.extend((int(key), short) for key in taps)
+            last_key = taps[0]
+        elif char in special_chars_keymap or char in emojis_keymap:
+            keys.append((key_codes["*"], long))
+            if char in special_chars_keymap:
+                keys.extend((ord(key), short) for key in special_chars_keymap[char])
+            else:
+                keys.append((key_codes["fnLeft"], short))
+                keys.extend((ord(key), short) for key in emojis_keymap[char])
+            keys.append((key_codes["enter"], short))
+            last_key = '\0'
+        else:
+            raise KeyError(char)
+    set_lowercase(False)
+    return KeyPlan(text, tuple(keys))
+
+
 def send_number(number: str, connection):
     if number.isnumeric():
         for digit in number:
             connection.send_key_code(int(digit))
-            time.sleep(0.3)
+            connection.settle()
 
 def validate_pin(pin):
     if len(pin) != 4:
@@ -274,33 +364,11 @@ def validate_pin(pin):
         if not isinstance(digit, int):
             raise TypeError("Pin could be only set of digits")
 
-### timeout from https://stackoverflow.com/a/601168/5752094
-
-from contextlib import contextmanager
-
-import signal
-
-
-class Timeout(Exception):
-    '''
-    usage:
-        try:
-            with Timeout.limit(10):
-                long_function_call()
-        except Timeout as e:
-            print("Timed out!")
-    '''
-
-    @classmethod
-    @contextmanager
-    def limit(cls, seconds: int):
-        assert seconds >= 1, "Timeout must be at least 1 second !"
-        def signal_handler(signum, frame):
-            raise Timeout("Timed out!")
+### timeout, kept here for compatibility
+# Timeout is cooperative deadline of interface.deadline now, it was SIGALRM before:
+#   - it stops Deadline.sleep, serial reads and harness requests, but not i.e. time.sleep loops,
+#     such code should wait with Deadline.sleep, or use Timeout.limit(seconds, interrupt=True)
+#     to get SIGALRM back (main thread only)
+#   - requests cut by it raise Timeout, not ComTimeout, so retry loops catching ComError don't swallow it
 
-        signal.signal(signal.SIGALRM, signal_handler)
-        signal.alarm(seconds)
-        try:
-            yield
-        finally:
-            signal.alarm(0)
+from .interface.deadline import Deadline, Timeout  # noqa: F401